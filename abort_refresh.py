@@ -11,6 +11,7 @@ import sys
 import psutil
 
 import config
+import pg
 import synctable
 from tabledesc import TableDesc
 
@@ -49,22 +50,43 @@ def find_refresh_process(tablename, sync_check=True):
 def kill_refresh(tablename, sync_check=True):
     '''
     Stop a table from being refreshed.
-    Any running refresh process is killed.
-    __sync table status is set to 'error'.
+    Any running refresh process is killed. The synchronizations run by
+    sync_daemon are threads, that can't be killed: This waits for them to
+    finish.
+    __sync table status is then set to 'error'.
+    The lock of the table is kept until the process exits, or calls
+    synctable.unlock, so that no synchronization can start meanwhile.
+    Returns whether a refresh was running.
     '''
     logger = logging.getLogger(__name__)
 
     td = TableDesc(tablename)
 
-    proc = find_refresh_process(tablename, sync_check)
-    if not proc:
+    if sync_check:
+        status = synctable.get_status(tablename)
+        if status != 'running':
+            logger.error('TABLE %s status is %s', tablename, status)
+            return False
+
+    proc = find_refresh_process(tablename, sync_check=False)
+    if proc:
+        proc.kill()
+
+    if synctable.lock(tablename, wait=False):
+        running = proc is not None
+    else:
+        logger.info('Waiting for the synchronization of %s to finish',
+                    tablename)
+        synctable.lock(tablename)
+        running = True
+
+    if not running:
         logger.error('Process not found')
+        pg.commit()  # Don't stay idle in transaction
         return False
 
     synctable.update(td, 'error')
 
-    proc.kill()
-
     return True
 
 
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+'''
+Migration for the tables created before createtable indexed the column used
+to poll the changes: That index is added to the tables that don't have any
+valid index starting with that column.
+Indexes are built CONCURRENTLY, so that the synchronization can go on. When
+that fails, an INVALID index is left: It is dropped and built again by the
+next run.
+'''
+
+import argparse
+import logging
+from time import time
+
+import config
+import pg
+from createtable import get_pgsql_timestamp_index, get_timestamp_index_name
+from tabledesc import TableDesc
+
+
+def get_sync_tablenames():
+    '''
+    Returns the names of all the tables in __sync
+    '''
+    cursor = pg.cursor()
+    cursor.execute('SELECT tablename FROM {} ORDER BY tablename'.format(
+        pg.table_name('__sync')))
+    return [row[0] for row in cursor]
+
+
+def table_exists(tablename):
+    '''
+    Returns whether the table exists
+    '''
+    cursor = pg.cursor()
+    cursor.execute('SELECT to_regclass(%s)', (pg.table_name(tablename),))
+    return cursor.fetchone()[0] is not None
+
+
+def has_index(tablename, column):
+    '''
+    Returns whether the table has a valid index whose first column is column
+    The name of the column is folded like in createtable, that lowercases it
+    unless DB_QUOTE_NAMES is set.
+    '''
+    cursor = pg.cursor()
+    cursor.execute('''
+        SELECT 1
+        FROM pg_index
+        JOIN pg_attribute ON attrelid = indrelid AND attnum = indkey[0]
+        WHERE indrelid = to_regclass(%s)
+        AND attname = (parse_ident(%s))[1]
+        AND indisvalid
+        ''', (pg.table_name(tablename), pg.escape_name(column)))
+    return cursor.fetchone() is not None
+
+
+def is_invalid_index(indexname):
+    '''
+    Returns whether the index exists, but is INVALID, because its creation
+    failed
+    '''
+    cursor = pg.cursor()
+    cursor.execute('''
+        SELECT 1
+        FROM pg_index
+        WHERE indexrelid = to_regclass(%s)
+        AND NOT indisvalid
+        ''', (pg.table_name(indexname),))
+    return cursor.fetchone() is not None
+
+
+def add_timestamp_index(tablename, method=config.TIMESTAMP_INDEX,
+                        dry_run=False):
+    '''
+    Create the index of the column used to poll the changes of a table,
+    unless there is already one.
+    '''
+    logger = logging.getLogger(__name__)
+    if not table_exists(tablename):
+        logger.warning('Table %s does not exist', tablename)
+        return
+    td = TableDesc(tablename)
+    timefield = td.get_timestamp_name()
+    if has_index(tablename, timefield):
+        logger.info('%s.%s is already indexed', tablename, timefield)
+        return
+    sql = get_pgsql_timestamp_index(td, method, concurrently=True)
+    if sql is None:
+        return
+    statements = []
+    indexname = get_timestamp_index_name(td)
+    if is_invalid_index(indexname):
+        # CREATE INDEX IF NOT EXISTS would keep it
+        statements.append('DROP INDEX CONCURRENTLY {};'.format(
+            pg.table_name(indexname)))
+    statements.append(sql)
+    if dry_run:
+        for sql in statements:
+            print(sql)
+        return
+    start = time()
+    for sql in statements:
+        logger.info('%s', sql)
+        pg.cursor().execute(sql)
+    logger.info('Indexed %s.%s in %.1f s', tablename, timefield,
+                time() - start)
+
+
+if __name__ == '__main__':
+    def main():
+        parser = argparse.ArgumentParser(
+            description='Index the column used to poll the changes of'
+                        ' existing tables')
+        parser.add_argument(
+                '--dry-run',
+                default=False, action='store_true',
+                help='only print the sql statements to stdout')
+        parser.add_argument(
+                '--method',
+                choices=('btree', 'brin'),
+                default=(config.TIMESTAMP_INDEX
+                         if config.TIMESTAMP_INDEX != 'none' else 'btree'),
+                help='index method. default=%(default)s')
+        parser.add_argument(
+                'table',
+                nargs='*',
+                help='tables to index. default is all the tables of __sync')
+        args = parser.parse_args()
+
+        logging.basicConfig(
+                filename=config.LOGFILE,
+                format=config.LOGFORMAT.format('add_timestamp_index'),
+                level=config.LOGLEVEL)
+
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        pg.set_autocommit(True)
+        for tablename in args.table or get_sync_tablenames():
+            add_timestamp_index(tablename, args.method, args.dry_run)
+
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+'''
+Benchmark of csv versus binary COPY on a wide table.
+The records are encoded first, then copied into a temporary table of the
+database configured in ~/.pgsf, so that both rates are reported separately.
+'''
+
+import argparse
+import io
+import os
+import tempfile
+from time import perf_counter
+
+from synthetic import SyntheticTableDesc, make_records
+
+import pg
+from createtable import postgres_coldef_from_sffield
+from csv_to_postgres import get_pgsql_copy
+from pgcopy import BinaryEncoder, CopyStream
+from query_poll_table import CsvEncoder
+
+
+def bench(td, records, encoder):
+    start = perf_counter()
+    data = CopyStream(records, encoder).read()
+    encoded = perf_counter()
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    cursor = pg.cursor()
+    cursor.execute('TRUNCATE TABLE {}'.format(
+        pg.table_name(td.name, schema='')))
+    sql = get_pgsql_copy(td, encoder.fieldnames, schema='',
+                         binary=encoder.binary)
+    cursor.copy_expert(sql, io.BytesIO(data))
+    copied = perf_counter()
+
+    print('{:6}: {:6.1f} MB, encode {:6.0f} rows/s, COPY {:6.0f} rows/s'
+          ' {:6.1f} MB/s, total {:6.0f} rows/s'.format(
+              'binary' if encoder.binary else 'csv',
+              len(data) / 1e6,
+              len(records) / (encoded - start),
+              len(records) / (copied - encoded),
+              len(data) / 1e6 / (copied - encoded),
+              len(records) / (copied - start)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark csv versus binary COPY ingest')
+    parser.add_argument(
+            '--records',
+            type=int,
+            default=200000,
+            help='number of records. default=%(default)s')
+    parser.add_argument(
+            '--width',
+            type=int,
+            default=10,
+            help='number of times the 11 sample fields are repeated.'
+                 ' default=%(default)s')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        td = SyntheticTableDesc(width=args.width)
+        records = make_records(td, args.records)
+
+        coldefs = []
+        for field in td.fields:
+            coldefs += postgres_coldef_from_sffield(field)
+        cursor = pg.cursor()
+        cursor.execute('CREATE TEMPORARY TABLE {} (\n{}\n)'.format(
+            pg.table_name(td.name, schema=''), ',\n'.join(coldefs)))
+        print('{} records, {} fields'.format(len(records), len(td.fields)))
+
+        for encoder in (CsvEncoder(td), BinaryEncoder(td)):
+            bench(td, records, encoder)
+        pg.get_conn().rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+'''
+Benchmark of the csv encoding of the changes in query_poll_table:
+records/sec of the per-field lookups of the original loop, versus CsvEncoder.
+'''
+
+import argparse
+import os
+import tempfile
+from time import perf_counter
+
+from synthetic import SyntheticTableDesc, make_records
+
+from query_poll_table import CsvEncoder, postgres_json_to_csv
+
+
+def encode_legacy(td, records):
+    '''
+    The original loop of download_changes: field info is looked up for each
+    field of each record.
+    '''
+    fieldnames = td.get_sync_field_names()
+    for record in records:
+        csv_formated_fields = []
+        for fieldname in fieldnames:
+            field = td.get_sync_fields()[fieldname]
+            csv_field_value = postgres_json_to_csv(field, record[fieldname])
+            csv_formated_fields.append(csv_field_value)
+        ','.join(csv_formated_fields)+'\n'
+
+
+def encode_compiled(td, records):
+    encoder = CsvEncoder(td)
+    for record in records:
+        encoder.encode(record)
+
+
+def bench(func, td, records):
+    start = perf_counter()
+    func(td, records)
+    return len(records) / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the csv encoding of changes')
+    parser.add_argument(
+            '--records',
+            type=int,
+            default=500000,
+            help='number of records. default=%(default)s')
+    parser.add_argument(
+            '--legacy-records',
+            type=int,
+            default=2000,
+            help='number of records for the original, much slower, loop.'
+                 ' default=%(default)s')
+    parser.add_argument(
+            '--width',
+            type=int,
+            default=3,
+            help='number of times the 11 sample fields are repeated.'
+                 ' default=%(default)s')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        td = SyntheticTableDesc(width=args.width)
+        records = make_records(td, args.records)
+        print('{} fields'.format(len(td.fields)))
+        before = bench(encode_legacy, td, records[:args.legacy_records])
+        print('before: {:10.0f} records/sec'.format(before))
+        after = bench(encode_compiled, td, records)
+        print('after:  {:10.0f} records/sec ({:.0f}x)'.format(
+            after, after / before))
+
+
+if __name__ == '__main__':
+    main()
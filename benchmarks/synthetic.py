@@ -0,0 +1,108 @@
+'''
+Synthetic table and records for the benchmarks.
+No connection to Salesforce or PostgreSQL is needed.
+'''
+
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tabledesc import TableDesc  # noqa: E402
+
+# A typical mix of field types, repeated to make wider tables
+FIELD_TYPES = (
+    ('Name', 'string'),
+    ('Email', 'email'),
+    ('Stage', 'picklist'),
+    ('Amount', 'currency'),
+    ('Quantity', 'int'),
+    ('Probability', 'percent'),
+    ('IsClosed', 'boolean'),
+    ('CloseDate', 'date'),
+    ('LastActivity', 'datetime'),
+    ('Description', 'textarea'),
+    ('OwnerId', 'reference'),
+    )
+
+
+def _field(name, sftype):
+    return {
+        'name': name,
+        'type': sftype,
+        'length': 255,
+        'precision': 18,
+        'scale': 2,
+        'nillable': name != 'Id',
+        'calculated': False,
+        'compoundFieldName': None,
+        'defaultValue': None,
+        'unique': False,
+        }
+
+
+class SyntheticTableDesc(TableDesc):
+    '''
+    TableDesc with generated fields. The mapping file is written in the
+    current directory, as it is by tabledesc.py.
+    '''
+    def __init__(self, name='Bench', width=3):
+        super().__init__(name)
+        self.fields = [
+            _field('Id', 'id'),
+            _field('IsDeleted', 'boolean'),
+            _field('SystemModstamp', 'datetime'),
+            ]
+        for i in range(width):
+            for name, sftype in FIELD_TYPES:
+                self.fields.append(_field('{}{}'.format(name, i), sftype))
+        os.makedirs('mapping', exist_ok=True)
+        with open('mapping/{}.csv'.format(self.name), 'w') as f:
+            f.write('"FieldName", "Import", "Indexed", "Note"\n')
+            for field in self.fields:
+                f.write('"{}",1,,\n'.format(field['name']))
+
+    def get_sf_desc(self):
+        return {'fields': self.fields}
+
+    def get_sf_field_definition(self):
+        return []
+
+
+def _value(sftype, i, rnd):
+    if rnd.random() < 0.1:
+        return None
+    if sftype in ('string', 'email', 'picklist', 'reference', 'id'):
+        return 'value "{}" {}'.format(sftype, i)
+    if sftype == 'textarea':
+        return 'Some longer text,\nwith "quotes" ' * 3
+    if sftype in ('currency', 'percent', 'double'):
+        return round(rnd.random() * 10000, 2)
+    if sftype == 'int':
+        return rnd.randint(0, 1000000)
+    if sftype == 'boolean':
+        return rnd.random() < 0.5
+    if sftype == 'date':
+        return '2021-03-{:02}'.format(i % 28 + 1)
+    if sftype == 'datetime':
+        date = datetime(2021, 1, 1) + timedelta(seconds=i)
+        return date.strftime('%Y-%m-%dT%H:%M:%S.000+0000')
+    return None
+
+
+def make_records(td, count, seed=0):
+    '''
+    Returns a list of count records, as returned by SF query
+    '''
+    rnd = random.Random(seed)
+    records = []
+    for i in range(count):
+        record = {'attributes': {'type': td.name}}
+        for field in td.fields:
+            record[field['name']] = _value(field['type'], i, rnd)
+        record['Id'] = '{:018}'.format(i)
+        record['IsDeleted'] = False
+        records.append(record)
+    return records
@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+'''
+Bulk API 2.0 query engine.
+
+A job runs a single query, that Salesforce splits by itself. Once the job is
+complete, the results are read by pages of up to max_records records. As the
+locator of the next page is in the headers of the current one, the next page
+is requested while the previous ones are still being received, so that
+several pages are downloaded at the same time.
+
+Pages are saved in JOB_DIR/<job>/<page>.CSV with status.json and
+batches.json, like download.py does, so that csv_to_postgres can import them.
+'''
+
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+
+import requests
+
+import config
+import download
+import pg
+from csv_to_postgres import get_pgsql_import
+from salesforce import get_Salesforce
+from salesforce_bulk import BulkApiError
+from tabledesc import TableDesc
+
+DEFAULT_WORKERS = download.DEFAULT_WORKERS
+DEFAULT_MAX_RECORDS = config.BULK2_MAX_RECORDS
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def _jobs_url(sf, job=None):
+    url = sf.base_url + 'jobs/query'
+    if job:
+        url += '/' + job
+    return url
+
+
+def create_query_job(tabledesc, where=None, limit=None,
+                     include_deleted=False):
+    '''
+    Start a query job for the synchronized fields of a table.
+    Returns the job id.
+    '''
+    fields = tabledesc.get_sync_field_names()
+    soql = 'SELECT ' + ','.join(fields) + ' FROM ' + tabledesc.name
+    if where:
+        soql += ' WHERE ' + where
+    if limit:
+        soql += ' LIMIT ' + str(limit)
+    logger.debug("Query: %s", soql)
+
+    sf = get_Salesforce()
+    result = sf._call_salesforce(
+            'POST', _jobs_url(sf), name='jobs/query',
+            data=json.dumps({
+                'operation': 'queryAll' if include_deleted else 'query',
+                'query': soql,
+                'contentType': 'CSV',
+                'columnDelimiter': 'COMMA',
+                'lineEnding': 'LF',
+                }))
+    return result.json()['id']
+
+
+def job_status(job):
+    '''
+    Returns the job information, as a dict
+    '''
+    sf = get_Salesforce()
+    return sf._call_salesforce(
+            'GET', _jobs_url(sf, job), name='jobs/query').json()
+
+
+def wait_job(job, pool_time=5):
+    '''
+    Wait until the job is complete.
+    Returns the final job status.
+    '''
+    while True:
+        try:
+            status = job_status(job)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            # At that point, a connection error is bad, but not fatal
+            # Let's retry
+            sleep(pool_time)
+            continue
+        logger.info('Job %s: %s, %s records', job, status['state'],
+                    status.get('numberRecordsProcessed'))
+        if status['state'] == 'JobComplete':
+            return status
+        if status['state'] in ('Failed', 'Aborted'):
+            raise BulkApiError('Job {} {}: {}'.format(
+                job, status['state'], status.get('errorMessage')))
+        sleep(pool_time)
+
+
+def _save_page(response, filename):
+    '''
+    Stream a result page into filename, through a temporary file.
+    NUL characters are stripped, as PostgreSQL rejects them.
+    Returns the number of records.
+    '''
+    tmpname = filename + '.tmp'
+    try:
+        with open(tmpname, 'wb') as file:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk.replace(b'\0', b''))
+    finally:
+        response.close()
+    os.replace(tmpname, filename)
+    return int(response.headers.get('Sforce-NumberOfRecords', 0))
+
+
+def download_pages(job, workers=DEFAULT_WORKERS,
+                   max_records=DEFAULT_MAX_RECORDS):
+    '''
+    Download the result pages of a complete job, with up to workers pages
+    being received at the same time.
+    Yields (page id, filename, number of records) as the pages are saved,
+    in order.
+    '''
+    sf = get_Salesforce()
+    url = _jobs_url(sf, job) + '/results'
+
+    pages = queue.Queue()
+    slots = threading.Semaphore(workers)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def save(response, page_id, filename):
+        try:
+            return page_id, filename, _save_page(response, filename)
+        finally:
+            slots.release()
+
+    def fetch():
+        try:
+            locator = None
+            page = 0
+            while True:
+                while not slots.acquire(timeout=1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                params = {'maxRecords': max_records}
+                if locator:
+                    params['locator'] = locator
+                response = sf._call_salesforce(
+                        'GET', url, name='jobs/query', params=params,
+                        headers={'Accept': 'text/csv'}, stream=True)
+                page_id = 'page{}'.format(page)
+                filename = download.batch_filename(job, page_id, 'CSV')
+                pages.put(executor.submit(save, response, page_id, filename))
+                locator = response.headers.get('Sforce-Locator')
+                if not locator or locator == 'null':
+                    break
+                page += 1
+        except Exception as exc:
+            pages.put(exc)
+        finally:
+            pages.put(None)
+
+    fetcher = threading.Thread(target=fetch)
+    fetcher.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is None:
+                break
+            if isinstance(page, Exception):
+                raise page
+            yield page.result()
+    finally:
+        stop.set()
+        fetcher.join()
+        executor.shutdown(wait=True)
+
+
+def _save_job_info(job, job_status, pages):
+    '''
+    Write status.json and batches.json, in the formats of Bulk v1, so that
+    csv_to_postgres can import the pages.
+    '''
+    download.save_json(job, 'status.json', job_status)
+    download.save_json(job, 'batches.json', [
+        {
+            'id': page_id,
+            'jobId': job,
+            'state': 'Completed',
+            'numberRecordsProcessed': str(rows),
+        }
+        for page_id, filename, rows in pages])
+
+
+def download_job(job, pool_time=5, workers=DEFAULT_WORKERS,
+                 max_records=DEFAULT_MAX_RECORDS):
+    '''
+    Wait for a job, and download all its result pages
+    '''
+    job_status = wait_job(job, pool_time)
+    os.makedirs(config.JOB_DIR + '/' + job, exist_ok=True)
+
+    start = time()
+    pages = list(download_pages(job, workers, max_records))
+    rows = sum(page[2] for page in pages)
+    elapsed = max(time() - start, 1e-6)
+    logger.info('Downloaded %s page(s), %s rows in %.1f s: %.0f rows/s',
+                len(pages), rows, elapsed, rows / elapsed)
+    _save_job_info(job, job_status, pages)
+
+
+def run_job(td, job,
+            pool_time=5,
+            workers=DEFAULT_WORKERS,
+            max_records=DEFAULT_MAX_RECORDS,
+            target_tablename=None,
+            schema=None):
+    '''
+    Wait for a job, and copy its result pages into the table, or into
+    target_tablename, that is truncated first. Pages are copied while the
+    next ones are being downloaded.
+    Returns the number of rows, and the final job status.
+    Same as refresh.run_job, for Bulk 2.0 jobs.
+    '''
+    job_status = wait_job(job, pool_time)
+    os.makedirs(config.JOB_DIR + '/' + job, exist_ok=True)
+
+    start = time()
+    cursor = pg.cursor()
+    sql = None
+    rows = 0
+    pages = []
+    for page_id, filename, page_rows in download_pages(
+            job, workers, max_records):
+        pages.append((page_id, filename, page_rows))
+        if not page_rows:
+            continue
+        if sql is None:
+            sql = 'TRUNCATE TABLE {}'.format(pg.table_name(
+                target_tablename or td.name, schema=schema))
+            logger.debug(sql)
+            cursor.execute(sql)
+            sql = get_pgsql_import(
+                    td, filename, target_tablename, schema=schema)
+            logger.debug('%s', sql)
+        with open(filename, 'rb') as file:
+            cursor.copy_expert(sql, file)
+        logger.debug('%s: rowcount %s', filename, cursor.rowcount)
+        rows += cursor.rowcount
+    elapsed = max(time() - start, 1e-6)
+    logger.info('Loaded %s rows in %.1f s: %.0f rows/s',
+                rows, elapsed, rows / elapsed)
+
+    _save_job_info(job, job_status, pages)
+    return rows, job_status
+
+
+if __name__ == '__main__':
+    def main():
+        parser = argparse.ArgumentParser(
+            description='Download a table with a Bulk API 2.0 query job',
+            epilog='The files can then be imported with csv_to_postgres.')
+        parser.add_argument(
+                '--where',
+                help='condition')
+        parser.add_argument(
+                '--limit',
+                type=int,
+                help='limit number of rows')
+        parser.add_argument(
+                '--include-deleted',
+                action='store_true',
+                help='include deleted records')
+        parser.add_argument(
+                '--workers',
+                type=int,
+                default=DEFAULT_WORKERS,
+                help='number of parallel downloads. default=%(default)s')
+        parser.add_argument(
+                '--max-records',
+                type=int,
+                default=DEFAULT_MAX_RECORDS,
+                help='maximum number of records per page.'
+                     ' default=%(default)s')
+        parser.add_argument(
+                'table',
+                help='table name')
+        args = parser.parse_args()
+
+        logging.basicConfig(
+                filename=config.LOGFILE,
+                format=config.LOGFORMAT.format('bulk2 '+args.table),
+                level=config.LOGLEVEL)
+
+        job = create_query_job(
+                TableDesc(args.table), where=args.where, limit=args.limit,
+                include_deleted=args.include_deleted)
+        logger.info('Created job %s', job)
+        print('Created job {}'.format(job))
+
+        download_job(job, workers=args.workers, max_records=args.max_records)
+
+    main()
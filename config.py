@@ -33,8 +33,30 @@ DB_SCHEMA = __cfg['postgresql'].get('schema', None)
 
 DB_QUOTE_NAMES = __cfg['postgresql'].getboolean('quote_name', False)
 GRANT_TO = __cfg['postgresql'].get('grant_to', None)
+COPY_BINARY = __cfg['postgresql'].getboolean('copy_binary', False)
+# Index created on the sync timestamp column: 'btree', 'brin' or 'none'
+TIMESTAMP_INDEX = __cfg['postgresql'].get('timestamp_index', 'btree')
 
 JOB_DIR = __cfg['DEFAULT']['job_dir']
+CACHE_DIR = __cfg['DEFAULT'].get('cache_dir', 'cache')
+# Minutes during which cached salesforce metadata is used without any check
+METADATA_TTL = __cfg['DEFAULT'].getint('metadata_ttl', 60)
+# Number of records per query page, 0 for the server default, or 'auto'
+QUERY_BATCH_SIZE = __cfg['DEFAULT'].get('query_batch_size', '0')
+if QUERY_BATCH_SIZE != 'auto':
+    QUERY_BATCH_SIZE = int(QUERY_BATCH_SIZE)
+# Number of query pages requested ahead of the one being read
+QUERY_PREFETCH = __cfg['DEFAULT'].getint('query_prefetch', 1)
+# Number of parallel queries used by query_poll_table for large backlogs
+DELTA_WORKERS = __cfg['DEFAULT'].getint('delta_workers', 1)
+# Number of changes from which query_poll_table uses a bulk query. 0 disables.
+BULK_THRESHOLD = __cfg['DEFAULT'].getint('bulk_threshold', 100000)
+# Number of changes applied per transaction by query_poll_table. 0 disables.
+APPLY_CHUNK_SIZE = __cfg['DEFAULT'].getint('apply_chunk_size', 0)
+# Bulk query engine of refresh and query_poll_table: 'bulk' or 'bulk2'
+BULK_ENGINE = __cfg['DEFAULT'].get('bulk_engine', 'bulk')
+# Maximum number of records of a Bulk API 2.0 result page
+BULK2_MAX_RECORDS = __cfg['DEFAULT'].getint('bulk2_max_records', 100000)
 
 LOGFILE = __cfg['DEFAULT']['log_file']
 LOGFORMAT = __cfg['DEFAULT']['log_format']
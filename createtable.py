@@ -84,7 +84,35 @@ def postgres_coldef_from_sffield(field):
     return [' {} {}'.format(pg.escape_name(field_name), pgtype)]
 
 
-def get_pgsql_create(table_name, grant_to=None):
+def get_timestamp_index_name(tabledesc):
+    '''
+    Returns the name of the index of the column used to poll the changes
+    '''
+    return '{}_{}_idx'.format(tabledesc.name, tabledesc.get_timestamp_name())
+
+
+def get_pgsql_timestamp_index(tabledesc, method=config.TIMESTAMP_INDEX,
+                              concurrently=False):
+    '''
+    Returns the CREATE INDEX statement for the column that is used to poll
+    the changes, or None if method is 'none'.
+    method is 'btree' or 'brin'. BRIN is much smaller, and is good enough
+    when the rows are mostly appended in timestamp order.
+    '''
+    if method == 'none':
+        return None
+    assert method in ('btree', 'brin'), 'Invalid index method ' + method
+    timefield = tabledesc.get_timestamp_name()
+    return 'CREATE INDEX {}IF NOT EXISTS {} ON {} USING {} ({});'.format(
+        'CONCURRENTLY ' if concurrently else '',
+        pg.escape_name(get_timestamp_index_name(tabledesc)),
+        pg.table_name(tabledesc.name),
+        method,
+        pg.escape_name(timefield))
+
+
+def get_pgsql_create(table_name, grant_to=None,
+                     timestamp_index=config.TIMESTAMP_INDEX):
     logger = logging.getLogger(__name__)
     logger.debug('Analyzing %s', table_name)
 
@@ -121,6 +149,11 @@ def get_pgsql_create(table_name, grant_to=None):
                             table_name, field_name)),
                     pg.table_name(table_name),
                     pg.escape_name(field_name)))
+    # Every poll selects on that column, indexed or not in salesforce.
+    # IF NOT EXISTS skips it when it was just created above.
+    sql = get_pgsql_timestamp_index(tabledesc, timestamp_index)
+    if sql is not None:
+        statements.append(sql)
     if grant_to is not None:
         statements.append('GRANT SELECT ON {} TO {};'.format(
             pg.table_name(table_name), grant_to))
@@ -139,6 +172,12 @@ if __name__ == '__main__':
                 '--grant-to',
                 default=config.GRANT_TO,
                 help='grant select to this table')
+        parser.add_argument(
+                '--timestamp-index',
+                choices=('btree', 'brin', 'none'),
+                default=config.TIMESTAMP_INDEX,
+                help='index of the column used to poll the changes.'
+                     ' default=%(default)s')
         parser.add_argument(
                 'table',
                 help='table to create in postgresql')
@@ -149,7 +188,8 @@ if __name__ == '__main__':
                 format=config.LOGFORMAT.format('createtable '+args.table),
                 level=config.LOGLEVEL)
 
-        sql = get_pgsql_create(args.table, args.grant_to)
+        sql = get_pgsql_create(
+                args.table, args.grant_to, args.timestamp_index)
         if args.dry_run:
             for line in sql:
                 print(line)
@@ -1,51 +1,202 @@
 #!/usr/bin/python3
 
 import argparse
+import codecs
 import json
 import logging
+import os
+import queue
+import re
+from concurrent.futures import ThreadPoolExecutor
+from time import time
 
 import config
 import pg
+import shadowtable
 import synctable
 from abort_refresh import kill_refresh
+from pgcopy import BinaryEncoder, CopyStream
 from tabledesc import TableDesc
 
+# Size of the chunks read from the JSON files, in bytes
+JSON_CHUNK_SIZE = 1024 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_json_decoder = json.JSONDecoder()
+
+
+def get_pgsql_copy(tabledesc,
+                   fields,
+                   target_tablename=None,
+                   schema=None,
+                   binary=False):
+    """
+    Returns the COPY statement for a csv stream with a header line and the
+    given list of fields. If binary is set, the stream is in binary format.
+    schema is set to '' for temporary tables
+    else the config is used: use None as a parameter
+    """
+    if target_tablename is None:
+        target_tablename = tabledesc.name
+
+    if binary:
+        return """COPY {quoted_table_name} ({fields})
+                  FROM STDIN WITH (FORMAT binary)""".format(
+                quoted_table_name=pg.table_name(
+                    target_tablename,
+                    schema),
+                fields=','.join([pg.escape_name(f) for f in fields]))
+
+    forcenull_fields = []
+    for fieldname, fieldinfo in tabledesc.get_sync_fields().items():
+        if fieldinfo['nillable']:
+            forcenull_fields.append(fieldname)
+    if forcenull_fields:
+        forcenull_fields = [
+                pg.escape_name(f) for f in forcenull_fields]
+        force_null = ', FORCE_NULL (' + ','.join(forcenull_fields) + ')'
+    else:
+        force_null = ''
+    return """COPY {quoted_table_name} ({fields})
+              FROM STDIN WITH (FORMAT csv, HEADER{force_null})""".format(
+            quoted_table_name=pg.table_name(
+                target_tablename,
+                schema),
+            fields=','.join([pg.escape_name(f) for f in fields]),
+            force_null=force_null)
+
 
 def get_pgsql_import(tabledesc,
                      csv_file_name,
                      target_tablename=None,
                      schema=None):
     """
+    Returns the COPY statement for a csv file. The list of fields is read
+    from the header of that file.
     schema is set to '' for temporary tables
     else the config is used: use None as a parameter
     """
-    if target_tablename is None:
-        target_tablename = tabledesc.name
     with open(csv_file_name) as f:
         header = f.readline()[:-1]
-        quoted_fields = header.split(',')
-        fields = [quoted_field.strip('"') for quoted_field in quoted_fields]
-
-        forcenull_fields = []
-        for fieldname, fieldinfo in tabledesc.get_sync_fields().items():
-            if fieldinfo['nillable']:
-                forcenull_fields.append(fieldname)
-        if forcenull_fields:
-            forcenull_fields = [
-                    pg.escape_name(f) for f in forcenull_fields]
-            force_null = ', FORCE_NULL (' + ','.join(forcenull_fields) + ')'
+    quoted_fields = header.split(',')
+    fields = [quoted_field.strip('"') for quoted_field in quoted_fields]
+    return get_pgsql_copy(tabledesc, fields, target_tablename, schema)
+
+
+def _read_json_records(file):
+    '''
+    Yields the records of a JSON file of a job, as they are decoded, so that
+    the file is never loaded at once. The file is an array of records, or
+    several concatenated arrays when a batch had several result sets.
+    '''
+    reader = codecs.getreader('utf-8')(file)
+    buf = ''
+    pos = 0
+    eof = False
+    expect = '['  # '[', 'record]', 'record' or ',]'
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                break
+            chunk = reader.read(JSON_CHUNK_SIZE)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        char = buf[pos]
+        if expect == '[' or expect == ',]' or \
+                (expect == 'record]' and char == ']'):
+            if char not in expect:
+                raise ValueError('Invalid JSON file: expected {!r} at {!r}'
+                                 .format(expect, buf[pos:][:50]))
+            pos += 1
+            expect = {'[': 'record]', ',': 'record', ']': '['}[char]
+            continue
+        try:
+            record, end = _json_decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The record continues in the next chunk
+            chunk = reader.read(JSON_CHUNK_SIZE)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        pos = end
+        expect = ',]'
+        yield record
+    if expect != '[':
+        raise ValueError('Invalid JSON file: unexpected end')
+
+
+def _copy_file(sql, filename, encoder=None):
+    '''
+    COPY a file of a job. csv bytes are sent unchanged. JSON records are
+    encoded by encoder.
+    Returns the number of rows.
+    '''
+    logger = logging.getLogger(__name__)
+    cursor = pg.cursor()
+    start = time()
+    with open(filename, 'rb') as file:
+        if encoder is not None:
+            cursor.copy_expert(
+                    sql, CopyStream(_read_json_records(file), encoder))
         else:
-            force_null = ''
-        return """COPY {quoted_table_name} ({fields})
-                  FROM STDIN WITH (FORMAT csv, HEADER{force_null})""".format(
-                quoted_table_name=pg.table_name(
-                    target_tablename,
-                    schema),
-                fields=','.join([pg.escape_name(f) for f in fields]),
-                force_null=force_null)
+            cursor.copy_expert(sql, file)
+    elapsed = max(time() - start, 1e-6)
+    size = os.path.getsize(filename)
+    logger.info('%s: %s rows, %.1f MB in %.1f s: %.0f rows/s, %.1f MB/s',
+                filename, cursor.rowcount, size / 1e6, elapsed,
+                cursor.rowcount / elapsed, size / 1e6 / elapsed)
+    return cursor.rowcount
+
 
+def _copy_files_parallel(sql, filenames, encoder, workers):
+    '''
+    COPY the files of a job with workers connections at the same time.
+    Each file is committed on its own, so the target must be a table that
+    readers don't see yet, such as a shadow table.
+    Each worker closes its connection once there is no file left.
+    Returns the number of rows.
+    '''
+    pending = queue.Queue()
+    for filename in filenames:
+        pending.put(filename)
 
-def job_csv_to_postgres(job, autocommit=True):
+    def copy_files():
+        rows = 0
+        try:
+            while True:
+                try:
+                    filename = pending.get_nowait()
+                except queue.Empty:
+                    return rows
+                try:
+                    rows += _copy_file(sql, filename, encoder)
+                    pg.commit()
+                except Exception:
+                    pg.get_conn().rollback()
+                    raise
+        finally:
+            pg.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(copy_files) for i in range(workers)]
+        return sum(future.result() for future in futures)
+
+
+def job_csv_to_postgres(job, autocommit=True, swap=False, workers=1):
+    '''
+    Import the files of a downloaded job into its table.
+    If swap is set, the files are loaded into a shadow table, that replaces
+    the table once complete, so that readers see the previous data
+    meanwhile. autocommit is then ignored.
+    If workers is more than 1, that many files are loaded at the same time,
+    each by its own connection. That implies swap.
+    '''
     logger = logging.getLogger(__name__)
 
     with open(config.JOB_DIR + '/' + job + '/' + 'status.json') as file:
@@ -55,20 +206,29 @@ def job_csv_to_postgres(job, autocommit=True):
 
     table_name = job_status['object']
 
-    kill_refresh(kill_refresh, sync_check=False)
+    kill_refresh(table_name, sync_check=False)
 
+    if workers > 1:
+        swap = True
+    if swap:
+        autocommit = False
     if autocommit:
         pg.set_autocommit(True)
     cursor = pg.cursor()
 
     td = TableDesc(table_name)
+    target_tablename = None
 
     if int(job_status['numberRecordsProcessed']):
 
-        sql = "TRUNCATE TABLE {quoted_table_name}".format(
-            quoted_table_name=pg.table_name(table_name))
-        logger.debug(sql)
-        cursor.execute(sql)
+        if swap:
+            target_tablename = shadowtable.shadow_name(table_name)
+            shadowtable.create(table_name)
+        else:
+            sql = "TRUNCATE TABLE {quoted_table_name}".format(
+                quoted_table_name=pg.table_name(table_name))
+            logger.debug(sql)
+            cursor.execute(sql)
 
         successfull_csv_files = [
                 '{}/{}/{}.{}'.format(
@@ -80,14 +240,41 @@ def job_csv_to_postgres(job, autocommit=True):
                 if batch['state'] == 'Completed'
                 ]
 
-        sql = get_pgsql_import(td, successfull_csv_files[0])
+        if job_status['contentType'] == 'JSON':
+            # Records are converted to binary COPY format
+            encoder = BinaryEncoder(td)
+            sql = get_pgsql_copy(td, encoder.fieldnames, target_tablename,
+                                 binary=True)
+        else:
+            encoder = None
+            sql = get_pgsql_import(
+                    td, successfull_csv_files[0], target_tablename)
 
         logger.debug('%s', sql)
 
-        for csv in successfull_csv_files:
-            with open(csv) as file:
-                cursor.copy_expert(sql, file)
-                logger.debug("rowcount: %s", cursor.rowcount)
+        start = time()
+        if workers > 1:
+            # The shadow table must be visible to the other connections
+            pg.commit()
+            rows = _copy_files_parallel(
+                    sql, successfull_csv_files, encoder, workers)
+        else:
+            rows = 0
+            for csv in successfull_csv_files:
+                rows += _copy_file(sql, csv, encoder)
+        elapsed = max(time() - start, 1e-6)
+        logger.info('Loaded %s rows from %s files in %.1f s: %.0f rows/s',
+                    rows, len(successfull_csv_files), elapsed,
+                    rows / elapsed)
+
+        if swap:
+            try:
+                shadowtable.build_indexes(table_name)
+                pg.commit()
+                shadowtable.swap(table_name)
+            except Exception:
+                pg.get_conn().rollback()
+                raise
     else:
         logger.critical('%s is empty', table_name)
 
@@ -105,6 +292,18 @@ if __name__ == '__main__':
                 '--autocommit',
                 action='store_true',
                 help='enable autocommit')
+        parser.add_argument(
+                '--swap',
+                action='store_true',
+                help='load into a shadow table, that replaces the table'
+                     ' once complete')
+        parser.add_argument(
+                '--workers',
+                type=int,
+                default=1,
+                help='number of files loaded at the same time, each by its'
+                     ' own connection. More than 1 implies --swap.'
+                     ' default=%(default)s')
         parser.add_argument(
                 'job',
                 help='Job id')
@@ -115,6 +314,7 @@ if __name__ == '__main__':
                 format=config.LOGFORMAT.format('csv_to_postgres '+args.job),
                 level=config.LOGLEVEL)
 
-        job_csv_to_postgres(args.job, args.autocommit)
+        job_csv_to_postgres(
+                args.job, args.autocommit, args.swap, args.workers)
 
     main()
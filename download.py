@@ -4,14 +4,18 @@ import argparse
 import json
 import logging
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 # from pprint import pprint
-from time import sleep
+from time import sleep, time
 
 import requests
 
 import config
 from salesforce import get_SalesforceBulk
 
+DEFAULT_WORKERS = 4
+
 # def write_csv_from_csv(outputfile, tabledesc, inputresult, write_header):
 #     r = inputresult.read()
 #     ru = str(r, encoding='utf-8')
@@ -43,7 +47,136 @@ from salesforce import get_SalesforceBulk
 #         write_header = False  # Var local copy
 
 
-def download(job, pool_time=5):
+def _download_result(bulk, job, batch_id, result_id, filename):
+    '''
+    Stream a single result set into filename.
+    The data is written in a temporary file that is renamed once complete.
+    Returns the number of bytes.
+    '''
+    logger = logging.getLogger(__name__)
+    logger.debug('Downloading batch %s result %s', batch_id, result_id)
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as file:
+        size = bulk.write_query_batch_results(
+                file, batch_id, result_id, job_id=job)
+    os.replace(tmpname, filename)
+    return size
+
+
+def _concat_files(filenames, filename, content_type):
+    '''
+    Atomically create filename from the concatenation of filenames, that are
+    then deleted.
+    Each CSV result set has a header line: Only the first one is kept.
+    '''
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as output:
+        for i, partname in enumerate(filenames):
+            with open(partname, 'rb') as part:
+                if i and content_type == 'CSV':
+                    part.readline()
+                shutil.copyfileobj(part, output)
+    os.replace(tmpname, filename)
+    for partname in filenames:
+        os.unlink(partname)
+
+
+def batch_filename(job, batch_id, content_type):
+    '''
+    Returns the name of the file where a batch results are saved
+    '''
+    return config.JOB_DIR + '/' + job + '/' + batch_id + '.' + content_type
+
+
+def save_json(job, basename, data):
+    '''
+    Write some job information, such as status.json, in the job directory
+    '''
+    with open(config.JOB_DIR + '/' + job + '/' + basename, 'w') as file:
+        file.write(json.dumps(data, indent=4))
+
+
+def download_batch(bulk, job, batch_id, content_type):
+    '''
+    Download all the result sets of a single batch, one after the other.
+    Returns a (filename, size) tuple.
+    '''
+    result_ids = bulk.get_query_batch_result_ids(batch_id, job_id=job)
+    if not result_ids:
+        raise RuntimeError('Batch {} is not complete'.format(batch_id))
+    filename = batch_filename(job, batch_id, content_type)
+    if len(result_ids) == 1:
+        size = _download_result(bulk, job, batch_id, result_ids[0], filename)
+    else:
+        partnames = ['{}.{}'.format(filename, i)
+                     for i in range(len(result_ids))]
+        size = 0
+        for result_id, partname in zip(result_ids, partnames):
+            size += _download_result(bulk, job, batch_id, result_id, partname)
+        _concat_files(partnames, filename, content_type)
+    return filename, size
+
+
+def download_batches(bulk, job, batches, content_type,
+                     workers=DEFAULT_WORKERS):
+    '''
+    Download the results of all the batches, using a pool of workers.
+    Each batch is saved in JOB_DIR/<job>/<batch>.<content_type>. If a batch
+    has several result sets, they are downloaded in parallel and
+    concatenated.
+    '''
+    logger = logging.getLogger(__name__)
+
+    batch_ids = []
+    total_rows = 0
+    for batch in batches:
+        if batch['state'] == 'NotProcessed':
+            logger.debug('Skipping batch %s in state "NotProcessed".',
+                         batch['id'])
+            continue
+        batch_ids.append(batch['id'])
+        total_rows += int(batch.get('numberRecordsProcessed') or 0)
+
+    start = time()
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        all_result_ids = executor.map(
+                lambda batch_id: bulk.get_query_batch_result_ids(
+                    batch_id, job_id=job),
+                batch_ids)
+
+        batch_parts = {}
+        futures = []
+        for batch_id, result_ids in zip(batch_ids, all_result_ids):
+            if not result_ids:
+                raise RuntimeError('Batch {} is not complete'.format(batch_id))
+            filename = batch_filename(job, batch_id, content_type)
+            if len(result_ids) == 1:
+                partnames = [filename]
+            else:
+                partnames = ['{}.{}'.format(filename, i)
+                             for i in range(len(result_ids))]
+                batch_parts[filename] = partnames
+            for result_id, partname in zip(result_ids, partnames):
+                futures.append(executor.submit(
+                    _download_result,
+                    bulk, job, batch_id, result_id, partname))
+
+        for future in as_completed(futures):
+            total_bytes += future.result()
+
+    for filename, partnames in batch_parts.items():
+        _concat_files(partnames, filename, content_type)
+
+    elapsed = max(time() - start, 1e-6)
+    logger.info(
+            'Downloaded %s batch(es), %.1f MB, %s rows in %.1f s: '
+            '%.2f MB/s, %.0f rows/s',
+            len(batch_ids), total_bytes / 1e6, total_rows, elapsed,
+            total_bytes / 1e6 / elapsed, total_rows / elapsed)
+
+
+def download(job, pool_time=5, workers=DEFAULT_WORKERS):
     logger = logging.getLogger(__name__)
     bulk = get_SalesforceBulk()
 
@@ -72,7 +205,8 @@ def download(job, pool_time=5):
             if nb_queued == 0 and nb_inprogress == 0:
                 break
 
-        except requests.exceptions.ConnectionError:
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
             # At that point, a connection error is bad, but not fatal
             # Let's retry
             pass
@@ -84,40 +218,30 @@ def download(job, pool_time=5):
         pass  # Already exists? Good!
 
     job_status = bulk.job_status(job)
-    with open(config.JOB_DIR + '/' + job + '/' + 'status.json', 'w') as file:
-        file.write(json.dumps(job_status, indent=4))
+    save_json(job, 'status.json', job_status)
 
     batches = bulk.get_batch_list(job)
-    with open(config.JOB_DIR + '/' + job + '/' + 'batches.json', 'w') as file:
-        file.write(json.dumps(batches, indent=4))
+    save_json(job, 'batches.json', batches)
 
-    for batch in bulk.get_batch_list(job):
-        batch_id = batch['id']
-        if batch['state'] == 'NotProcessed':
-            logger.debug('Skipping batch %s in state "NotProcessed".',
-                         batch_id)
-            continue
-        filename = (config.JOB_DIR + '/' + job + '/' + batch_id + '.'
-                    + job_status['contentType'])
-        with open(filename, 'wb') as file:
-            logger.info('Downloading batch %s', batch_id)
-            for chunk in bulk.get_all_results_for_query_batch(batch_id, job):
-                file.write(chunk.read())
+    download_batches(bulk, job, batches, job_status['contentType'], workers)
 
     if job_status['state'] == 'Open':
         logger.info('Closing job')
         bulk.close_job(job)
         job_status = bulk.job_status(job)
         # Update the data after closing the job
-        jsonfilename = config.JOB_DIR + '/' + job + '/' + 'status.json'
-        with open(jsonfilename, 'w') as file:
-            file.write(json.dumps(job_status, indent=4))
+        save_json(job, 'status.json', job_status)
 
 
 if __name__ == '__main__':
     def main():
         parser = argparse.ArgumentParser(
             description='Download csv data from salesforce')
+        parser.add_argument(
+                '--workers',
+                type=int,
+                default=DEFAULT_WORKERS,
+                help='number of parallel downloads. default=%(default)s')
         parser.add_argument(
                 'job',
                 help='job id')
@@ -130,6 +254,6 @@ if __name__ == '__main__':
 
         job = args.job
 
-        download(job)
+        download(job, workers=args.workers)
 
     main()
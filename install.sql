@@ -9,8 +9,14 @@ create table salesforce.__sync (
 	syncuntil timestamp,
 	refresh_minutes int default 10,
 	last_refresh timestamp,
-	status salesforce.jobstatus not null default 'ready'
+	status salesforce.jobstatus not null default 'ready',
+	priority int not null default 0,
+	last_method varchar(4),
+	last_duration real
 );
 comment on column salesforce.__sync.tablename is 'From SF EntityDefinition.QualifiedApiName';
 comment on column salesforce.__sync.syncuntil is 'UTC';
 comment on column salesforce.__sync.last_refresh is 'Local time';
+comment on column salesforce.__sync.priority is 'sync_daemon runs the highest priority first';
+comment on column salesforce.__sync.last_method is 'How query_poll_table fetched the changes the last time: rest or bulk';
+comment on column salesforce.__sync.last_duration is 'Seconds, of the last query_poll_table';
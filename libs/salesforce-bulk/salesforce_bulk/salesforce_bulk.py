@@ -77,13 +77,31 @@ job_to_http_content_type = {
 
 DEFAULT_CLIENT_ID_PREFIX = 'PySFBulk'
 DEFAULT_API_VERSION = "40.0"
+DEFAULT_POOL_SIZE = 10
+DEFAULT_STREAM_CHUNK_SIZE = 1024 * 1024
 
 
 class SalesforceBulk(object):
 
     def __init__(self, sessionId=None, host=None, username=None, password=None,
                  API_version=DEFAULT_API_VERSION, domain=None,
-                 security_token=None, organizationId=None, client_id=None):
+                 security_token=None, organizationId=None, client_id=None,
+                 session=None, pool_size=DEFAULT_POOL_SIZE, timeout=None,
+                 compress=False):
+        """
+        session -- requests.Session to use, for example the one of a
+                   simple_salesforce.Salesforce instance. If None, a new one
+                   is created with a connection pool of pool_size.
+        timeout -- timeout passed to requests: seconds, or a (connect, read)
+                   tuple. None waits forever.
+        compress -- gzip the batches sent by post_batch
+        """
+        if session is None:
+            session = self.create_session(pool_size)
+        self.session = session
+        self.timeout = timeout
+        self.compress = compress
+
         if not sessionId and not username:
             raise RuntimeError(
                 "Must supply either sessionId/instance_url or username/password")
@@ -105,6 +123,20 @@ class SalesforceBulk(object):
         self.batch_statuses = {}
         self.API_version = API_version
 
+    @staticmethod
+    def create_session(pool_size=DEFAULT_POOL_SIZE, session=None):
+        """
+        Returns a requests.Session keeping up to pool_size connections alive.
+        If session is given, the connection pools are set up on it.
+        """
+        if session is None:
+            session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
     @staticmethod
     def login_to_salesforce(username, password, domain=None, security_token=None,
                             organizationId=None, client_id=None, API_version=DEFAULT_API_VERSION):
@@ -195,9 +227,9 @@ class SalesforceBulk(object):
                                   concurrency=concurrency,
                                   external_id_name=external_id_name)
 
-        resp = requests.post(self.endpoint + "/job",
-                             headers=self.headers(extra_headers),
-                             data=doc)
+        resp = self.session.post(self.endpoint + "/job",
+                                 headers=self.headers(extra_headers),
+                                 data=doc, timeout=self.timeout)
         self.check_status(resp)
 
         tree = ET.fromstring(resp.content)
@@ -214,7 +246,7 @@ class SalesforceBulk(object):
 
     def get_batch_list(self, job_id):
         url = self.endpoint + "/job/{}/batch".format(job_id)
-        resp = requests.get(url, headers=self.headers())
+        resp = self.session.get(url, headers=self.headers(), timeout=self.timeout)
         self.check_status(resp)
         results = self.parse_response(resp)
         if isinstance(results, dict):
@@ -228,24 +260,25 @@ class SalesforceBulk(object):
             job_id = self.lookup_job_id(batch_id)
 
         url = self.endpoint + "/job/{}/batch/{}/request".format(job_id, batch_id)
-        resp = requests.get(url, headers=self.headers())
+        resp = self.session.get(url, headers=self.headers(), timeout=self.timeout)
         self.check_status(resp)
         return resp.text
 
     def close_job(self, job_id):
         doc = self.create_close_job_doc()
         url = self.endpoint + "/job/%s" % job_id
-        resp = requests.post(url, headers=self.headers(), data=doc)
+        resp = self.session.post(url, headers=self.headers(), data=doc, timeout=self.timeout)
         self.check_status(resp)
 
     def abort_job(self, job_id):
         """Abort a given bulk job"""
         doc = self.create_abort_job_doc()
         url = self.endpoint + "/job/%s" % job_id
-        resp = requests.post(
+        resp = self.session.post(
             url,
             headers=self.headers(),
-            data=doc
+            data=doc,
+            timeout=self.timeout
         )
         self.check_status(resp)
 
@@ -308,7 +341,7 @@ class SalesforceBulk(object):
         headers = self.headers(content_type=http_content_type)
 
         uri = self.endpoint + "/job/%s/batch" % job_id
-        resp = requests.post(uri, data=soql, headers=headers)
+        resp = self.session.post(uri, data=soql, headers=headers, timeout=self.timeout)
 
         self.check_status(resp)
 
@@ -331,7 +364,11 @@ class SalesforceBulk(object):
 
         uri = self.endpoint + "/job/%s/batch" % job_id
         headers = self.headers(content_type=http_content_type)
-        resp = requests.post(uri, data=data_generator, headers=headers)
+        if self.compress:
+            data_generator = util.gzip_bytes(
+                util.read_all_bytes(data_generator))
+            headers['Content-Encoding'] = 'gzip'
+        resp = self.session.post(uri, data=data_generator, headers=headers, timeout=self.timeout)
         self.check_status(resp)
 
         result = self.parse_response(resp)
@@ -345,7 +382,7 @@ class SalesforceBulk(object):
         http_content_type = job_to_http_content_type[job_content_type]
         uri = self.endpoint + "/job/%s/spec" % job_id
         headers = self.headers(content_type=http_content_type)
-        resp = requests.post(uri, data=mapping_data, headers=headers)
+        resp = self.session.post(uri, data=mapping_data, headers=headers, timeout=self.timeout)
         self.check_status(resp)
 
         if resp.status_code != 201:
@@ -361,7 +398,7 @@ class SalesforceBulk(object):
     def job_status(self, job_id=None):
         job_id = job_id
         uri = urlparse.urljoin(self.endpoint + "/", 'job/{0}'.format(job_id))
-        response = requests.get(uri, headers=self.headers())
+        response = self.session.get(uri, headers=self.headers(), timeout=self.timeout)
         self.check_status(response)
 
         tree = ET.fromstring(response.content)
@@ -406,7 +443,7 @@ class SalesforceBulk(object):
 
         uri = self.endpoint + \
             "/job/%s/batch/%s" % (job_id, batch_id)
-        resp = requests.get(uri, headers=self.headers())
+        resp = self.session.get(uri, headers=self.headers(), timeout=self.timeout)
         self.check_status(resp)
 
         result = self.parse_response(resp)
@@ -447,7 +484,7 @@ class SalesforceBulk(object):
             "job/{0}/batch/{1}/result".format(
                 job_id, batch_id),
         )
-        resp = requests.get(uri, headers=self.headers())
+        resp = self.session.get(uri, headers=self.headers(), timeout=self.timeout)
         self.check_status(resp)
 
         if resp.headers['Content-Type'] == 'application/json':
@@ -487,7 +524,7 @@ class SalesforceBulk(object):
                 job_id, batch_id, result_id),
         )
 
-        resp = requests.get(uri, headers=self.headers(), stream=True)
+        resp = self.session.get(uri, headers=self.headers(), stream=True, timeout=self.timeout)
         self.check_status(resp)
         if raw:
             return resp.raw
@@ -495,6 +532,33 @@ class SalesforceBulk(object):
         iter = (x.replace(b'\0', b'') for x in resp.iter_content(chunk_size=chunk_size))
         return util.IteratorBytesIO(iter)
 
+    def write_query_batch_results(self, fileobj, batch_id, result_id, job_id=None,
+                                  chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+        """
+        Stream a result set into fileobj, one chunk at a time, so that memory
+        usage does not depend on the size of the result.
+        NUL characters are stripped from each chunk.
+        Returns the number of bytes written.
+        """
+        job_id = job_id or self.lookup_job_id(batch_id)
+
+        uri = urlparse.urljoin(
+            self.endpoint + "/",
+            "job/{0}/batch/{1}/result/{2}".format(
+                job_id, batch_id, result_id),
+        )
+
+        resp = self.session.get(uri, headers=self.headers(), stream=True, timeout=self.timeout)
+        self.check_status(resp)
+
+        size = 0
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            if b'\0' in chunk:
+                chunk = chunk.replace(b'\0', b'')
+            fileobj.write(chunk)
+            size += len(chunk)
+        return size
+
     def get_batch_results(self, batch_id, job_id=None):
         job_id = job_id or self.lookup_job_id(batch_id)
 
@@ -504,7 +568,7 @@ class SalesforceBulk(object):
                 job_id, batch_id),
         )
 
-        resp = requests.get(uri, headers=self.headers(), stream=True)
+        resp = self.session.get(uri, headers=self.headers(), stream=True, timeout=self.timeout)
         self.check_status(resp)
 
         iter = (x.replace(b'\0', b'') for x in resp.iter_content())
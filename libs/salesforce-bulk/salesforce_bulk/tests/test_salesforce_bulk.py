@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import gzip
 import io
 import json
 import mock
@@ -20,10 +21,11 @@ from itertools import islice
 
 from six.moves import range
 
+import requests
 import unicodecsv
 
 from salesforce_bulk import SalesforceBulk, BulkApiError, UploadResult
-from salesforce_bulk import CsvDictsAdapter, bulk_states
+from salesforce_bulk import CsvDictsAdapter, bulk_states, util
 from salesforce_bulk.salesforce_bulk import BulkJobAborted, BulkBatchFailed
 
 nsclean = re.compile('{.*}')
@@ -68,6 +70,34 @@ class SalesforceBulkTests(unittest.TestCase):
             }
         )
 
+    def test_session_pool(self):
+        bulk = SalesforceBulk(self.sessionId, self.host, pool_size=4)
+        adapter = bulk.session.get_adapter(self.host)
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+    def test_session_shared(self):
+        session = requests.Session()
+        bulk = SalesforceBulk(self.sessionId, self.host, session=session,
+                              timeout=(10, 300))
+        self.assertIs(bulk.session, session)
+        self.assertEqual(bulk.timeout, (10, 300))
+
+    def test_post_batch_compressed(self):
+        session = mock.Mock()
+        session.post.return_value.status_code = 201
+        session.post.return_value.headers = {
+            'Content-Type': 'application/json'}
+        session.post.return_value.json.return_value = {'id': 'batch1'}
+        bulk = SalesforceBulk(self.sessionId, self.host, session=session,
+                              compress=True)
+        bulk.job_content_types['job1'] = 'CSV'
+        batch_id = bulk.post_batch('job1', io.BytesIO(b'"Id"\n"001"\n'))
+        self.assertEqual(batch_id, 'batch1')
+        kwargs = session.post.call_args[1]
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(kwargs['data'])).read(),
+                         b'"Id"\n"001"\n')
+
     def test_create_job_doc(self):
         doc = self.bulk.create_job_doc(
             'Contact', 'insert'
@@ -481,3 +511,32 @@ class SalesforceBulkIntegrationTestXML(SalesforceBulkIntegrationTestCSV):
         ]
 
         return result
+
+
+class IteratorBytesIOTests(unittest.TestCase):
+
+    def test_read_sizes(self):
+        fd = util.IteratorBytesIO([b'abc', b'', b'defgh', b'ij'])
+        self.assertEqual(fd.read(2), b'ab')
+        self.assertEqual(fd.read(1), b'c')
+        self.assertEqual(fd.read(4), b'defg')
+        self.assertEqual(fd.read(10), b'hij')
+        self.assertEqual(fd.read(3), b'')
+
+    def test_read_all(self):
+        fd = util.IteratorBytesIO([b'abc', b'defgh'])
+        self.assertEqual(fd.read(1), b'a')
+        self.assertEqual(fd.read(), b'bcdefgh')
+
+    def test_readlines(self):
+        fd = util.IteratorBytesIO([b'a\nb', b'c\nd'])
+        self.assertEqual(list(fd), [b'a\n', b'bc\n', b'd'])
+
+
+class ReadAllBytesTests(unittest.TestCase):
+
+    def test_types(self):
+        self.assertEqual(util.read_all_bytes(b'ab'), b'ab')
+        self.assertEqual(util.read_all_bytes(u'\xe9'), b'\xc3\xa9')
+        self.assertEqual(util.read_all_bytes(io.BytesIO(b'ab')), b'ab')
+        self.assertEqual(util.read_all_bytes([b'a', u'b']), b'ab')
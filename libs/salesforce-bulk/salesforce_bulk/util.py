@@ -1,13 +1,64 @@
-from io import IOBase
-from itertools import chain, islice
+import gzip
+from io import BytesIO, IOBase
+
+from six import text_type
 
 
 class IteratorBytesIO(IOBase):
+    """Readable file-like object over an iterator of bytes chunks"""
     def __init__(self, iterator):
-        self.iterator = chain.from_iterable(iterator or [])
+        self.iterator = iter(iterator or [])
+        self.buffer = b''
+        self.pos = 0
 
     def readable(self):
         return True
 
     def read(self, n=None):
-        return bytes(bytearray(islice(self.iterator, None, n)))
+        if n is None or n < 0:
+            chunks = [self.buffer[self.pos:]]
+            chunks.extend(self.iterator)
+            self.buffer = b''
+            self.pos = 0
+            return b''.join(chunks)
+
+        if self.pos + n <= len(self.buffer):
+            data = self.buffer[self.pos:self.pos + n]
+            self.pos += n
+            return data
+
+        chunks = [self.buffer[self.pos:]]
+        size = len(chunks[0])
+        for chunk in self.iterator:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= n:
+                break
+        self.buffer = b''.join(chunks)
+        data = self.buffer[:n]
+        self.pos = len(data)
+        return data
+
+
+def read_all_bytes(data):
+    """
+    Returns a request body as bytes. data can be bytes, text, a readable
+    file-like object, or an iterable of chunks.
+    """
+    if hasattr(data, 'read'):
+        data = data.read()
+    if isinstance(data, text_type):
+        return data.encode('utf-8')
+    if isinstance(data, bytes):
+        return data
+    return b''.join(
+        chunk.encode('utf-8') if isinstance(chunk, text_type) else chunk
+        for chunk in data)
+
+
+def gzip_bytes(data):
+    """Returns data compressed in the gzip format"""
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as gzfile:
+        gzfile.write(data)
+    return buf.getvalue()
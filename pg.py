@@ -2,11 +2,14 @@
 
 import argparse
 import logging
+import threading
 
 import psycopg2
 
 import config
 
+__pg_local = threading.local()
+
 
 def connect_string(with_password=True):
     '''
@@ -64,15 +67,26 @@ def get_conn():
     '''
     Return *the* common psycopg connection to the database
     based on config
+    Each thread has its own connection, that is kept for reuse. A closed
+    connection is opened again.
     '''
-    global __pg_connection
-    try:
-        return __pg_connection
-    except NameError:
+    conn = getattr(__pg_local, 'connection', None)
+    if conn is None or conn.closed:
         logger = logging.getLogger(__name__)
         logger.debug('Opening new connection to postgres')
-        __pg_connection = psycopg2.connect(connect_string())
-        return __pg_connection
+        conn = psycopg2.connect(connect_string())
+        __pg_local.connection = conn
+    return conn
+
+
+def close():
+    '''
+    Close the connection of the current thread, if it has one
+    '''
+    conn = getattr(__pg_local, 'connection', None)
+    if conn is not None:
+        conn.close()
+        __pg_local.connection = None
 
 
 def cursor():
@@ -0,0 +1,218 @@
+'''
+That module streams records into PostgreSQL COPY.
+
+BinaryEncoder writes the PGCOPY binary format, so that PostgreSQL does not
+have to parse text for numbers, booleans, dates and timestamps. See
+https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+'''
+
+import itertools
+import operator
+import struct
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from createtable import postgres_type_raw
+
+HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+TRAILER = struct.pack('!h', -1)
+NULL = struct.pack('!i', -1)
+
+PG_EPOCH_DAY = date(2000, 1, 1).toordinal()
+PG_EPOCH = datetime(2000, 1, 1)
+UNIX_EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+_int4 = struct.Struct('!i')
+_int4_field = struct.Struct('!ii')
+_int8_field = struct.Struct('!iq')
+_float8_field = struct.Struct('!id')
+_bool_true = struct.pack('!ib', 1, 1)
+_bool_false = struct.pack('!ib', 1, 0)
+_numeric_header = struct.Struct('!ihhhh')
+
+
+def _binary_text(value):
+    if not isinstance(value, str):
+        value = str(value)
+    data = value.replace('\0', '').encode('utf-8')
+    return _int4.pack(len(data)) + data
+
+
+def _binary_int4(value):
+    return _int4_field.pack(4, int(value))
+
+
+def _binary_float8(value):
+    return _float8_field.pack(8, float(value))
+
+
+def _binary_boolean(value):
+    return _bool_true if value else _bool_false
+
+
+def _from_timestamp_ms(value):
+    '''
+    Bulk API JSON results have dates as milliseconds since 1970
+    '''
+    return UNIX_EPOCH + timedelta(milliseconds=value)
+
+
+def _binary_date(value):
+    if isinstance(value, str):
+        day = date.fromisoformat(value[:10])
+    else:
+        day = _from_timestamp_ms(value).date()
+    return _int4_field.pack(4, day.toordinal() - PG_EPOCH_DAY)
+
+
+def _binary_timestamp(value):
+    '''
+    Like PostgreSQL does for TIMESTAMP, the time zone of text values, always
+    +0000 in salesforce, is ignored.
+    '''
+    if isinstance(value, str):
+        # 2019-11-18T15:28:14.000+0000
+        if value[19:20] == '.':
+            moment = datetime.fromisoformat(value[:23])
+        else:
+            moment = datetime.fromisoformat(value[:19])
+    else:
+        moment = _from_timestamp_ms(value)
+    return _int8_field.pack(8, (moment - PG_EPOCH) // MICROSECOND)
+
+
+def _binary_numeric(value):
+    '''
+    NUMERIC is sent as base 10000 digits, with a weight for the first one.
+    '''
+    text = value if isinstance(value, str) else str(value)
+    if 'e' in text or 'E' in text or 'n' in text or 'N' in text:
+        value = Decimal(text)
+        if not value.is_finite():
+            return _numeric_header.pack(8, 0, 0, 0xC000, 0)
+        text = format(value, 'f')
+    negative = text.startswith('-')
+    int_part, _, frac_part = text.lstrip('+-').partition('.')
+    dscale = len(frac_part)
+    int_part = int_part.rjust((len(int_part) + 3) // 4 * 4, '0')
+    digits = int_part + frac_part.ljust((dscale + 3) // 4 * 4, '0')
+    groups = [int(digits[i:i+4]) for i in range(0, len(digits), 4)]
+    weight = len(int_part) // 4 - 1
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    return (_numeric_header.pack(
+                8 + 2 * len(groups),
+                len(groups), weight, 0x4000 if negative else 0, dscale)
+            + struct.pack('!{}H'.format(len(groups)), *groups))
+
+
+def _binary_converter(field):
+    '''
+    Returns the function converting a non-null json value returned by SF
+    into a binary COPY field, including its length.
+    That is based on the column type created by createtable.
+    '''
+    pgtype = postgres_type_raw(field)
+    if pgtype.startswith('VARCHAR') or pgtype == 'TEXT':
+        return _binary_text
+    if pgtype == 'INTEGER':
+        return _binary_int4
+    if pgtype == 'DATE':
+        return _binary_date
+    if pgtype == 'TIMESTAMP':
+        return _binary_timestamp
+    if pgtype == 'BOOLEAN':
+        return _binary_boolean
+    if pgtype.startswith('NUMERIC'):
+        return _binary_numeric
+    if pgtype == 'DOUBLE PRECISION':
+        return _binary_float8
+    raise NotImplementedError(
+            'No binary COPY for {} field {}'.format(
+                field['type'], field['name']))
+
+
+class BinaryEncoder:
+    '''
+    Converts the records returned by SF query into binary COPY tuples.
+    It is built once per table, like query_poll_table.CsvEncoder.
+    '''
+    binary = True
+
+    def __init__(self, td, tuples=False):
+        '''
+        If tuples is set, records are tuples of the values of the
+        fieldnames, rather than dicts.
+        '''
+        self.fieldnames = td.get_sync_field_names()
+        sync_fields = td.get_sync_fields()
+        self.converters = [
+                _binary_converter(sync_fields[fieldname])
+                for fieldname in self.fieldnames]
+        if tuples:
+            self.getter = lambda record: record
+        elif len(self.fieldnames) == 1:
+            fieldname = self.fieldnames[0]
+            self.getter = lambda record: (record[fieldname],)
+        else:
+            self.getter = operator.itemgetter(*self.fieldnames)
+        self.tuple_header = struct.pack('!h', len(self.converters))
+
+    def header(self):
+        return HEADER
+
+    def trailer(self):
+        return TRAILER
+
+    def encode(self, record):
+        '''
+        Returns the binary tuple for a record
+        '''
+        return self.tuple_header + b''.join([
+            NULL if value is None else convert(value)
+            for convert, value in zip(self.converters, self.getter(record))])
+
+
+class CopyStream:
+    '''
+    Read-only file-like object over records, encoded on demand by an encoder
+    such as query_poll_table.CsvEncoder or BinaryEncoder.
+    It can be given to cursor.copy_expert, so that rows are copied while the
+    next records are still being fetched.
+    If tee is a writable file, the data is also written there.
+    '''
+    def __init__(self, records, encoder, tee=None):
+        self.lines = itertools.chain(
+                [encoder.header()],
+                map(encoder.encode, records),
+                [encoder.trailer()])
+        self.empty = encoder.header()[:0]
+        self.buffer = self.empty
+        self.tee = tee
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = self.empty.join(chunks)
+        if 0 <= size < len(data):
+            data, self.buffer = data[:size], data[size:]
+        else:
+            self.buffer = self.empty
+        if self.tee is not None:
+            self.tee.write(data)
+        return data
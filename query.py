@@ -1,18 +1,44 @@
 #!/usr/bin/python3
 
 import argparse
+import codecs
 import json
 import logging
+import operator
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import config
 from salesforce import get_Salesforce
 from simple_salesforce.exceptions import SalesforceMalformedRequest
 
-# from concurrent.futures import ThreadPoolExecutor
-
 
 logger = logging.getLogger(__name__)
 
+# Page size limits of Sforce-Query-Options batchSize
+MIN_BATCH_SIZE = 200
+MAX_BATCH_SIZE = 2000
+
+# Goals of the 'auto' batch size
+PAGE_TARGET_SECONDS = 2
+PAGE_MAX_BYTES = 4 * 1024 * 1024
+
+# Bytes read at once from query responses
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Records passed at once to the consumer of a query
+STREAM_CHUNK_RECORDS = 200
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_json_decoder = json.JSONDecoder()
+
+# tablename -> _BatchSizer
+__batch_sizers = {}
+__batch_sizers_lock = threading.Lock()
+
 
 # def query_cb(soql, chunk_callback, include_deleted=False):
 
@@ -34,20 +60,285 @@ def updated(tablename, start, end):
 #       datetime(2099,12,31,0,0,0,tzinfo=timezone.utc)))
 
 
-def query(soql, include_deleted=False):
+def _put(que, item, stop):
+    '''
+    Blocking put, unless the stop event is set.
+    Returns False if it was stopped.
+    '''
+    while not stop.is_set():
+        try:
+            que.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _prefetch(iterator, depth):
+    '''
+    Run an iterator in a background thread, that keeps up to depth items
+    ahead of the consumer.
+    Exceptions are raised again in the consumer.
+    '''
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def run():
+        try:
+            for item in iterator:
+                if not _put(items, item, stop):
+                    return
+        except Exception as exc:
+            _put(items, exc, stop)
+        finally:
+            _put(items, done, stop)
+
+    # A daemon, so that a consumer that stops does not wait for a pending
+    # request
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class _BatchSizer:
+    '''
+    Adapts the page size of the queries of a table, so that pages take about
+    PAGE_TARGET_SECONDS, and are less than PAGE_MAX_BYTES.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+
+    def update(self, seconds, nbytes, nrecords):
+        '''
+        Use the measures of a full page to compute the next page size
+        '''
+        if nrecords == 0:
+            return
+        ideal = nrecords * min(
+                PAGE_TARGET_SECONDS / max(seconds, 1e-3),
+                PAGE_MAX_BYTES / max(nbytes, 1))
+        with self.lock:
+            # Only go half the way, as measures are noisy
+            size = int((self.size + ideal) / 2)
+            size = max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, size))
+            if size != self.size:
+                logger.debug('Batch size %s -> %s', self.size, size)
+                self.size = size
+
+
+def _get_batch_sizer(soql):
+    '''
+    Returns the _BatchSizer of the table of a query
+    '''
+    match = re.search(r'\bFROM\s+(\w+)', soql, re.IGNORECASE)
+    tablename = match.group(1) if match else ''
+    with __batch_sizers_lock:
+        sizer = __batch_sizers.get(tablename)
+        if sizer is None:
+            sizer = __batch_sizers[tablename] = _BatchSizer(MAX_BATCH_SIZE)
+        return sizer
+
+
+class _PageReader:
+    '''
+    Incremental decoder of the JSON of a query result page.
+    Iterating yields the records, as plain dicts, while the response is
+    still being received. After that, result has the other attributes of the
+    page ('done', 'nextRecordsUrl', ...), and nbytes the size of the
+    response.
+    '''
+    def __init__(self, response):
+        self.chunks = response.iter_content(STREAM_CHUNK_SIZE)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.nbytes = 0
+        self.result = {}
+
+    def _fill(self):
+        '''
+        Append the next chunk of the response to the buffer.
+        Returns False at the end of the response.
+        '''
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self.decoder.decode(b'', final=True)
+        else:
+            self.nbytes += len(chunk)
+            text = self.decoder.decode(chunk)
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        '''
+        Skip white spaces, and returns the next character, or '' at the end
+        '''
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        '''
+        Read the next character, that must be one of chars
+        '''
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError('Invalid query result: expected {!r} at {!r}'
+                             .format(chars, self.buf[self.pos:][:50]))
+        self.pos += 1
+        return char
+
+    def _value(self):
+        '''
+        Read the next JSON value
+        '''
+        self._peek()
+        while True:
+            try:
+                value, end = _json_decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                # A number could continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            self._fill()
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'records':
+                self._expect('[')
+                if self._peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+                self.result[key] = []
+            else:
+                self.result[key] = self._value()
+            if self._expect(',}') == '}':
+                break
+
+
+def _query_pages(soql, include_deleted=False, batch_size=0, fields=None):
+    '''
+    Yields the records of a query, by lists of at most STREAM_CHUNK_RECORDS
+    records, as soon as they are received.
+    batch_size is the number of records per page, between 200 and 2000, or
+    0 for the Salesforce default, or 'auto'.
+    If fields is set, records are tuples of these fields.
+    '''
     sf = get_Salesforce()
-    result = sf.query(soql, include_deleted=include_deleted)
+
+    sizer = None
+    if batch_size == 'auto':
+        sizer = _get_batch_sizer(soql)
+
+    if fields is None:
+        convert = None
+    elif len(fields) == 1:
+        fieldname = fields[0]
+
+        def convert(record):
+            return (record[fieldname],)
+    else:
+        convert = operator.itemgetter(*fields)
+
+    def headers():
+        size = sizer.size if sizer else batch_size
+        if size:
+            return {'Sforce-Query-Options': 'batchSize={}'.format(size)}
+        return {}
+
+    response = sf.query_response(
+            soql, include_deleted=include_deleted, headers=headers())
     while True:
+        # Only the time spent receiving the page is measured, not the time
+        # the consumer holds the records.
+        start = time.time()
+        elapsed = 0
+        page = _PageReader(response)
+        nrecords = 0
+        chunk = []
+        try:
+            for record in page:
+                if convert is not None:
+                    record = convert(record)
+                chunk.append(record)
+                if len(chunk) >= STREAM_CHUNK_RECORDS:
+                    nrecords += len(chunk)
+                    elapsed += time.time() - start
+                    yield chunk
+                    start = time.time()
+                    chunk = []
+        finally:
+            response.close()
+        elapsed += time.time() - start
+        nrecords += len(chunk)
+        if chunk:
+            yield chunk
+
+        result = page.result
         _check_result(result)
-        records = result['records']
-        logger.info('sf.query got %s record(s).', len(records))
-        for record in records:
-            yield record
-        if not result['done']:
-            result = sf.query_more(result['nextRecordsUrl'],
-                                   identifier_is_url=True)
-        else:
+        logger.info('sf.query got %s record(s).', nrecords)
+        if sizer and not result['done']:
+            sizer.update(elapsed, page.nbytes, nrecords)
+        if result['done']:
             break
+        response = sf.query_more_response(
+                result['nextRecordsUrl'], headers=headers())
+
+
+def query(soql, include_deleted=False, prefetch=None, batch_size=None,
+          fields=None):
+    '''
+    Yields the records of a query, as they are received and decoded.
+    Records are dicts, or tuples of the values of fields, if set.
+    The next prefetch pages are requested in the background while the
+    records of the current one are consumed, so about prefetch + 2 pages
+    are in memory. Default is config.QUERY_PREFETCH. 0 disables that.
+    batch_size is the number of records per page: See _query_pages.
+    Default is config.QUERY_BATCH_SIZE.
+    '''
+    if prefetch is None:
+        prefetch = config.QUERY_PREFETCH
+    if batch_size is None:
+        batch_size = config.QUERY_BATCH_SIZE
+    chunks = _query_pages(
+            soql, include_deleted=include_deleted, batch_size=batch_size,
+            fields=fields)
+    if prefetch > 0:
+        chunks = _prefetch(
+                chunks, prefetch * MAX_BATCH_SIZE // STREAM_CHUNK_RECORDS)
+    for records in chunks:
+        yield from records
 
 
 def query_count(soql, include_deleted=False):
@@ -65,6 +356,58 @@ def query_count(soql, include_deleted=False):
     return result['totalSize']
 
 
+def query_parallel(soqls, include_deleted=False, workers=4, chunk_size=2000,
+                   fields=None):
+    '''
+    Run several queries at the same time, with at most workers queries
+    running concurrently.
+    Yields all the records, in no particular order. See query for fields.
+    Records are passed by chunks of chunk_size, and at most two chunks per
+    worker are waiting, so that memory stays bounded.
+    '''
+    chunks = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+    done = object()  # Marks the end of one query
+
+    def put(item):
+        return _put(chunks, item, stop)
+
+    def run(soql):
+        try:
+            chunk = []
+            for record in query(soql, include_deleted=include_deleted,
+                                fields=fields):
+                chunk.append(record)
+                if len(chunk) >= chunk_size:
+                    if not put(chunk):
+                        return
+                    chunk = []
+            if chunk:
+                put(chunk)
+        except Exception as exc:
+            put(exc)
+        finally:
+            put(done)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = [executor.submit(run, soql) for soql in soqls]
+    try:
+        running = len(futures)
+        while running:
+            chunk = chunks.get()
+            if chunk is done:
+                running -= 1
+            elif isinstance(chunk, Exception):
+                raise chunk
+            else:
+                yield from chunk
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
 if __name__ == '__main__':
     def main():
         parser = argparse.ArgumentParser(
@@ -2,45 +2,211 @@
 
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import config
+from query import query, query_count
 from salesforce import get_SalesforceBulk
 from salesforce_bulk.salesforce_bulk import BulkApiError
 from tabledesc import TableDesc
 
+# Number of records per batch, like the default of PK chunking
+DEFAULT_CHUNK_SIZE = 100000
+
+# Number of Id ranges counted per batch, when splitting without PK chunking
+RANGES_PER_CHUNK = 4
+
+# Maximum number of times the ranges with too many records are split again
+SPLIT_ROUNDS = 3
+
+# Number of COUNT() queries run at the same time
+COUNT_WORKERS = 4
+
+# Digits of Salesforce Ids, in the order of SOQL comparisons
+ID_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+ID_LENGTH = 15
+
 logger = logging.getLogger(__name__)
 
 
+def _id_to_int(sfid):
+    result = 0
+    for digit in sfid[:ID_LENGTH]:
+        result = result * len(ID_DIGITS) + ID_DIGITS.index(digit)
+    return result
+
+
+def _int_to_id(value):
+    digits = []
+    for i in range(ID_LENGTH):
+        value, digit = divmod(value, len(ID_DIGITS))
+        digits.append(ID_DIGITS[digit])
+    return ''.join(reversed(digits))
+
+
+def _id_range_where(begin, end):
+    '''
+    Returns the SOQL condition for Ids in [begin, end).
+    begin and end are ints, or None for an open range.
+    '''
+    conditions = []
+    if begin is not None:
+        conditions.append("Id >= '{}'".format(_int_to_id(begin)))
+    if end is not None:
+        conditions.append("Id < '{}'".format(_int_to_id(end)))
+    return ' AND '.join(conditions)
+
+
+def _and(*conditions):
+    conditions = [condition for condition in conditions if condition]
+    if len(conditions) == 1:
+        return conditions[0]
+    return ' AND '.join('(' + condition + ')' for condition in conditions)
+
+
+def _split_range(begin, end, parts):
+    '''
+    Split a range of Ids in parts of the same width
+    '''
+    parts = min(parts, end - begin)
+    if parts < 2:
+        return [(begin, end)]
+    bounds = [begin + (end - begin) * i // parts for i in range(parts)]
+    return list(zip(bounds, bounds[1:] + [end]))
+
+
+def split_id_ranges(tabledesc, where=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                    include_deleted=False):
+    '''
+    Returns a list of (begin, end) Id ranges, with about chunk_size records
+    each, for the objects that don't support PK chunking.
+    The Ids between the first and the last ones are split in
+    RANGES_PER_CHUNK ranges per chunk, that are counted. The ranges with too
+    many records are narrowed to their first and last Ids, split and counted
+    again, up to SPLIT_ROUNDS times, so that gaps in the Ids, such as between
+    instances, are skipped. Then the ranges are merged.
+    Ids are ints. The first begin and the last end are None.
+    '''
+    def soql(fields, id_range=(None, None)):
+        result = 'SELECT ' + fields + ' FROM ' + tabledesc.name
+        condition = _and(where, _id_range_where(*id_range))
+        if condition:
+            result += ' WHERE ' + condition
+        return result
+
+    def count(id_range):
+        return query_count(soql('COUNT()', id_range), include_deleted)
+
+    def narrow(id_range):
+        first = list(query(soql('Id', id_range) + ' ORDER BY Id LIMIT 1',
+                           include_deleted, prefetch=0))
+        last = list(query(soql('Id', id_range) + ' ORDER BY Id DESC LIMIT 1',
+                          include_deleted, prefetch=0))
+        if not first or not last:
+            return id_range
+        return _id_to_int(first[0]['Id']), _id_to_int(last[0]['Id']) + 1
+
+    def parts(range_count):
+        return -(-range_count // chunk_size) * RANGES_PER_CHUNK
+
+    total = count((None, None))
+    if total is None or total <= chunk_size:
+        return [(None, None)]
+    begin, end = narrow((None, None))
+    if begin is None:
+        return [(None, None)]
+
+    ranges = _split_range(begin, end, parts(total))
+    with ThreadPoolExecutor(max_workers=COUNT_WORKERS) as executor:
+        counts = list(executor.map(count, ranges))
+        for i in range(SPLIT_ROUNDS):
+            if None in counts:
+                break
+            full = [id_range
+                    for id_range, range_count in zip(ranges, counts)
+                    if range_count > chunk_size]
+            if not full:
+                break
+            narrowed = dict(zip(full, executor.map(narrow, full)))
+            new_ranges = []
+            new_counts = []
+            for id_range, range_count in zip(ranges, counts):
+                if id_range in narrowed:
+                    split = _split_range(
+                            *narrowed[id_range], parts(range_count))
+                    new_ranges += split
+                    new_counts += [None] * len(split)
+                else:
+                    new_ranges.append(id_range)
+                    new_counts.append(range_count)
+            tocount = [id_range
+                       for id_range, range_count in zip(new_ranges,
+                                                        new_counts)
+                       if range_count is None]
+            results = iter(executor.map(count, tocount))
+            counts = [next(results) if range_count is None else range_count
+                      for range_count in new_counts]
+            ranges = new_ranges
+    if None in counts:
+        logger.error('Could not count the records. Not splitting.')
+        return [(None, None)]
+
+    result = []
+    range_begin = None
+    cumulated = 0
+    for (begin, end), range_count in zip(ranges, counts):
+        if (cumulated and cumulated + range_count > chunk_size
+                and begin != range_begin):
+            result.append((range_begin, begin))
+            range_begin = begin
+            cumulated = 0
+        cumulated += range_count
+    result.append((range_begin, None))
+    logger.info('Splitting %s records in %s Id ranges', total, len(result))
+    return result
+
+
 def make_query(tabledesc,
                content_type='CSV',
                where=None, limit=None,
-               pk_chunking=True):
+               pk_chunking=True,
+               include_deleted=False):
     table_name = tabledesc.name
     fields = tabledesc.get_sync_field_names()
+    operation = 'queryAll' if include_deleted else 'query'
+    id_ranges = [(None, None)]
 
     bulk = get_SalesforceBulk()
     try:
-        job = bulk.create_query_job(table_name,
-                                    contentType=content_type,
-                                    pk_chunking=pk_chunking)
+        job = bulk.create_job(table_name, operation,
+                              contentType=content_type,
+                              pk_chunking=pk_chunking)
     except BulkApiError as exc:
         try:
             arg = exc.args[0]
         except (AttributeError, IndexError):
             raise exc
         if 'is not supported to use PKChunking' in arg:
-            logger.warning('PKChunking failed. Trying without.')
-            job = bulk.create_query_job(table_name,
-                                        contentType=content_type)
+            logger.warning('PKChunking failed. Splitting by Id ranges.')
+            job = bulk.create_job(table_name, operation,
+                                  contentType=content_type)
         else:
             raise
-    query = 'SELECT ' + ','.join(fields) + ' FROM ' + table_name
-    if where:
-        query += ' WHERE ' + where
-    if limit:
-        query += ' LIMIT ' + str(limit)
-    logger.debug("Query: %s", query)
-    bulk.query(job, query)
+        if not limit:
+            if pk_chunking is True:
+                pk_chunking = DEFAULT_CHUNK_SIZE
+            id_ranges = split_id_ranges(
+                    tabledesc, where, pk_chunking, include_deleted)
+    soql = 'SELECT ' + ','.join(fields) + ' FROM ' + table_name
+    for id_range in id_ranges:
+        batch_soql = soql
+        condition = _and(where, _id_range_where(*id_range))
+        if condition:
+            batch_soql += ' WHERE ' + condition
+        if limit:
+            batch_soql += ' LIMIT ' + str(limit)
+        logger.debug("Query: %s", batch_soql)
+        bulk.query(job, batch_soql)
     # bulk.close_job(job)
 
     return job
@@ -1,21 +1,47 @@
 #!/usr/bin/python3
 
 import argparse
+import collections
+import itertools
 import logging
-from datetime import datetime
+import operator
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
+import bulk2
 import config
 import pg
-from csv_to_postgres import get_pgsql_import
-from query import query
+from csv_to_postgres import get_pgsql_copy
+from pgcopy import BinaryEncoder, CopyStream
+from query import query, query_count, query_parallel
+from query_bulk import make_query
+import refresh
 import synctable
 from tabledesc import TableDesc
 
+# Number of time windows counted per worker, when splitting the changes
+WINDOWS_PER_WORKER = 4
 
-def create_csv_query_file(tablename):
-    return '{}/query_{}_{}.csv'.format(
+# Maximum number of times the windows with too many changes are split again
+SPLIT_ROUNDS = 3
+
+# Changes are not split below that number of records
+SLICE_MIN_RECORDS = 10000
+
+# Suffix of the staging tables, where the changes are copied first
+STAGING_SUFFIX = '__staging'
+
+# First version of PostgreSQL with MERGE
+MERGE_SERVER_VERSION = 150000
+
+
+def create_csv_query_file(tablename, extension='csv'):
+    return '{}/query_{}_{}.{}'.format(
             config.JOB_DIR, tablename,
-            datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+            datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            extension)
 
 
 def _csv_quote(value):
@@ -23,40 +49,226 @@ def _csv_quote(value):
     return '"' + value.replace('"', '""').replace('\0', '') + '"'
 
 
-def postgres_json_to_csv(field, value):
+def _csv_str(value):
+    return str(value)
+
+
+def _csv_anytype(value):
+    return _csv_quote(str(value))
+
+
+def _csv_boolean(value):
+    return 't' if value else 'f'
+
+
+def _csv_converter(field):
     '''
-    Given a field, this converts a json value returned by SF query into a csv
-    compatible value.
+    Returns the function converting a non-null json value returned by SF query
+    into a csv compatible value, for that field.
     '''
     sftype = field['type']
-    if value is None:
-        return ''
     if sftype in (
             'combobox', 'email', 'encryptedstring', 'id', 'multipicklist',
             'picklist', 'phone', 'reference', 'string', 'textarea', 'url'):
-        return _csv_quote(value)
+        return _csv_quote
     if sftype == 'anyType':
-        return _csv_quote(str(value))
+        return _csv_anytype
     if sftype == 'int':
-        return str(value)
+        return _csv_str
     if sftype == 'date':
-        return str(value)
+        return _csv_str
     if sftype == 'datetime':
-        return str(value)  # 2019-11-18T15:28:14.000Z TODO check
+        return _csv_str  # 2019-11-18T15:28:14.000Z TODO check
     if sftype == 'boolean':
-        return 't' if value else 'f'
+        return _csv_boolean
     if sftype in ('currency', 'double', 'percent'):
-        return str(value)
-    return '"{}" NOT IMPLEMENTED '.format(sftype)
+        return _csv_str
+    not_implemented = '"{}" NOT IMPLEMENTED '.format(sftype)
+    return lambda value: not_implemented
 
 
-def download_changes(td):
+def postgres_json_to_csv(field, value):
     '''
-    td is a tabledesc object
-    returns the name of the csvfile where the changes where downloaded.
+    Given a field, this converts a json value returned by SF query into a csv
+    compatible value.
+    '''
+    if value is None:
+        return ''
+    return _csv_converter(field)(value)
+
+
+class CsvEncoder:
+    '''
+    Converts the records returned by SF query into csv lines.
+    It is built once per table: the field types are only looked up once.
+    '''
+    binary = False
+
+    def __init__(self, td, tuples=False):
+        '''
+        If tuples is set, records are tuples of the values of the
+        fieldnames, rather than dicts.
+        '''
+        self.fieldnames = td.get_sync_field_names()
+        sync_fields = td.get_sync_fields()
+        self.converters = [
+                _csv_converter(sync_fields[fieldname])
+                for fieldname in self.fieldnames]
+        if tuples:
+            self.getter = None
+        elif len(self.fieldnames) == 1:
+            fieldname = self.fieldnames[0]
+            self.getter = lambda record: (record[fieldname],)
+        else:
+            self.getter = operator.itemgetter(*self.fieldnames)
+
+    def header(self):
+        return ','.join(self.fieldnames) + '\n'
+
+    def trailer(self):
+        return ''
+
+    def encode(self, record):
+        '''
+        Returns the csv line for a record, including the end of line
+        '''
+        if self.getter is not None:
+            record = self.getter(record)
+        return ','.join([
+            '' if value is None else convert(value)
+            for convert, value in zip(self.converters, record)]) + '\n'
+
+
+def _changes_where(td, start, end=None):
+    '''
+    Returns the SOQL condition of the records changed after start, and until
+    end if it is not None.
+    start and end are naive UTC datetimes.
+    '''
+    timefield = td.get_timestamp_name()
+    where = "{}>{}".format(
+            timefield,
+            start.strftime('%Y-%m-%dT%H:%M:%SZ')  # UTC
+            )
+    if end is not None:
+        where += " AND {}<={}".format(
+            timefield,
+            end.strftime('%Y-%m-%dT%H:%M:%SZ'))
+    return where
+
+
+def _changes_soql(td, select, start, end=None):
+    '''
+    Returns the SOQL query of the records changed after start, and until
+    end if it is not None.
+    '''
+    return "SELECT {} FROM {} WHERE {}".format(
+            select,
+            td.name,
+            _changes_where(td, start, end))
+
+
+def _split_window(begin, end, now, parts):
+    '''
+    Split a time window in parts of the same duration, with whole seconds.
+    end is None for an open window, that is split until now.
+    '''
+    seconds = int(((end or now) - begin).total_seconds())
+    parts = min(parts, seconds)
+    if parts < 2:
+        return [(begin, end)]
+    bounds = [begin + timedelta(seconds=seconds * i // parts)
+              for i in range(parts)]
+    return list(zip(bounds, bounds[1:] + [end]))
+
+
+def _split_changes(td, start, workers, total=None):
+    '''
+    Returns a list of (start, end) time windows covering the changes after
+    start, with about the same number of records in each window.
+    end is None for the last window.
+    Records are counted in WINDOWS_PER_WORKER windows per worker. The
+    windows with too many records are split and counted again, up to
+    SPLIT_ROUNDS times. Then the windows are merged.
+    A single window is returned when there are less than SLICE_MIN_RECORDS
+    changes. total is the number of changes, if it is already known, so that
+    nothing is counted in that case.
+    '''
+    logger = logging.getLogger(__name__)
+
+    if total is not None and total < SLICE_MIN_RECORDS:
+        return [(start, None)]
+
+    def count(window):
+        return query_count(
+                _changes_soql(td, 'COUNT()', *window),
+                include_deleted=True)
+
+    now = datetime.utcnow().replace(microsecond=0)
+    start = start.replace(microsecond=0)
+    windows = _split_window(start, None, now, workers * WINDOWS_PER_WORKER)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        counts = list(executor.map(count, windows))
+        if None in counts:
+            logger.error('Could not count the changes. Not splitting.')
+            return [(start, None)]
+        total = sum(counts)
+        logger.debug('%s changes in %s', total, td.name)
+        if total < SLICE_MIN_RECORDS:
+            return [(start, None)]
+
+        target = total / workers
+        for i in range(SPLIT_ROUNDS):
+            new_windows = []
+            new_counts = []
+            split = False
+            for window, window_count in zip(windows, counts):
+                parts = _split_window(*window, now, WINDOWS_PER_WORKER)
+                if window_count > target and len(parts) > 1:
+                    split = True
+                    new_windows += parts
+                    new_counts += [None] * len(parts)
+                else:
+                    new_windows.append(window)
+                    new_counts.append(window_count)
+            if not split:
+                break
+            tocount = [window
+                       for window, window_count in zip(new_windows,
+                                                       new_counts)
+                       if window_count is None]
+            results = iter(executor.map(count, tocount))
+            counts = [next(results) if window_count is None
+                      else window_count
+                      for window_count in new_counts]
+            if None in counts:
+                logger.error('Could not count the changes. Not splitting.')
+                return [(start, None)]
+            windows = new_windows
+
+    result = []
+    window_start = start
+    cumulated = 0
+    for (begin, end), count in zip(windows, counts):
+        cumulated += count
+        if (cumulated >= target * (len(result) + 1)
+                and end is not None
+                and len(result) < workers - 1):
+            result.append((window_start, end))
+            window_start = end
+    result.append((window_start, None))
+    logger.info('Fetching %s changes in %s windows from %s',
+                total, len(result),
+                ', '.join(str(begin) for begin, end in result))
+    return result
+
+
+def get_syncuntil(td):
+    '''
+    Returns the time of the last change that was synchronized, or None if
+    there is no sync information.
     '''
     logger = logging.getLogger(__name__)
-    fieldnames = td.get_sync_field_names()
 
     cursor = pg.cursor()
     cursor.execute(
@@ -71,135 +283,587 @@ def download_changes(td):
                         "Please use bulk the first time",
                         td.name)
         return None
-    lastsync = line[0]  # type is datetime
+    return line[0]  # type is datetime
 
-    timefield = td.get_timestamp_name()
 
-    soql = "SELECT {} FROM {} WHERE {}>{}".format(
-            ','.join(fieldnames),
-            td.name,
-            timefield,
-            lastsync.strftime('%Y-%m-%dT%H:%M:%SZ')  # UTC
+def query_changes_since(td, lastsync, workers=1, tuples=False,
+                        count=None):
+    '''
+    td is a tabledesc object
+    returns a generator of the records changed after lastsync.
+    If workers is more than 1, large backlogs are split in time windows that
+    are fetched in parallel. The same record may then be returned twice.
+    If tuples is set, records are tuples in get_sync_field_names order.
+    count is the number of changes, if it is already known.
+    '''
+    logger = logging.getLogger(__name__)
+    fieldnames = td.get_sync_field_names()
+
+    if workers > 1:
+        windows = _split_changes(td, lastsync, workers, count)
+    else:
+        windows = [(lastsync, None)]
+
+    soqls = [_changes_soql(td, ','.join(fieldnames), begin, end)
+             for begin, end in windows]
+    for soql in soqls:
+        logger.debug("%s", soql)
+    fields = fieldnames if tuples else None
+    if len(soqls) == 1:
+        return query(soqls[0], include_deleted=True, fields=fields)
+    return query_parallel(soqls, include_deleted=True, workers=workers,
+                          fields=fields)
+
+
+def _changed_condition(td, src, dest):
+    '''
+    Returns the SQL condition for a record of src that should update the
+    row of dest: It is not older, and some value differs.
+    '''
+    fieldnames = td.get_sync_field_names()
+    timefield = pg.escape_name(td.get_timestamp_name())
+    return '''({src}.{timefield} < {dest}.{timefield}) IS NOT TRUE
+              AND ( {src_fields} ) IS DISTINCT FROM ( {dest_fields} )
+           '''.format(
+            src=src,
+            dest=dest,
+            timefield=timefield,
+            src_fields=','.join(
+                [src+'.'+pg.escape_name(f) for f in fieldnames]),
+            dest_fields=','.join(
+                [dest+'.'+pg.escape_name(f) for f in fieldnames]),
             )
-    logger.debug("%s", soql)
-    qry = query(soql, include_deleted=True)
-    output = None
-    csvfilename = None
-    for record in qry:
-        if output is None:
-            csvfilename = create_csv_query_file(td.name)
-            output = open(csvfilename, 'w')
-            output.write(','.join(fieldnames)+'\n')
-        csv_formated_fields = []
-        for fieldname in fieldnames:
-            field = td.get_sync_fields()[fieldname]
-            csv_field_value = postgres_json_to_csv(field, record[fieldname])
-            csv_formated_fields.append(csv_field_value)
-        # print(record)
-        # print(','.join(csv_formated_fields)+'\n')
-        # output.write(repr(record))
-        output.write(','.join(csv_formated_fields)+'\n')
-    if output is not None:
-        output.close()
-    return csvfilename
-
-
-def pg_merge_update(td, tmp_tablename):
+
+
+def _source(staging_tablename, where=None):
+    '''
+    Returns the staging table, or the subquery of its records matching where
+    '''
+    if where is None:
+        return pg.table_name(staging_tablename)
+    return '(SELECT * FROM {} WHERE {})'.format(
+            pg.table_name(staging_tablename), where)
+
+
+def _count_changes(td, staging_tablename, where=None):
+    '''
+    Returns the numbers of records of the staging table that will be
+    inserted, updated, unchanged and deleted. That joins the staging table
+    with the table: It is only used for debugging.
+    '''
+    cursor = pg.cursor()
+    deleted = 'src."IsDeleted"' if 'IsDeleted' in td.get_sync_field_names() \
+        else 'FALSE'
+    cursor.execute('''
+        SELECT count(*) FILTER (WHERE dest.{id} IS NULL AND NOT {deleted}),
+               count(*) FILTER (WHERE dest.{id} IS NOT NULL AND NOT {deleted}
+                                AND {changed}),
+               count(*) FILTER (WHERE dest.{id} IS NOT NULL AND NOT {deleted}
+                                AND NOT ({changed})),
+               count(*) FILTER (WHERE dest.{id} IS NOT NULL AND {deleted})
+        FROM {quoted_table_src} src
+        LEFT JOIN {quoted_table_dest} dest ON dest.{id} = src.{id}
+        '''.format(
+            quoted_table_dest=pg.table_name(td.name),
+            quoted_table_src=_source(staging_tablename, where),
+            id=pg.escape_name(td.get_pk_fieldname()),
+            deleted=deleted,
+            changed=_changed_condition(td, 'src', 'dest'),
+            ))
+    return dict(zip(('inserted', 'updated', 'unchanged', 'deleted'),
+                    cursor.fetchone()))
+
+
+def _pg_merge(td, staging_tablename, where=None):
+    '''
+    Apply the changes with a single MERGE, PostgreSQL 15+
+    Returns the number of rows inserted, updated or deleted, in a dict.
+    '''
+    logger = logging.getLogger(__name__)
+    cursor = pg.cursor()
+
+    fieldnames = td.get_sync_field_names()
+    has_isdeleted = 'IsDeleted' in fieldnames
+    quoted_field_names = ','.join(
+            [pg.escape_name(f) for f in fieldnames])
+    source_quoted_field_names = ','.join(
+            ['src.'+pg.escape_name(f) for f in fieldnames])
+    sql = '''MERGE INTO {quoted_table_dest} dest
+             USING {quoted_table_src} src
+             ON dest.{id} = src.{id}
+             {whendeleted}
+             WHEN MATCHED AND {changed} THEN
+                 UPDATE SET ( {quoted_field_names} )
+                 = ( {source_quoted_field_names} )
+             WHEN NOT MATCHED {andnotdeleted} THEN
+                 INSERT ( {quoted_field_names} )
+                 VALUES ( {source_quoted_field_names} )
+          '''.format(
+            quoted_table_dest=pg.table_name(td.name),
+            quoted_table_src=_source(staging_tablename, where),
+            quoted_field_names=quoted_field_names,
+            source_quoted_field_names=source_quoted_field_names,
+            id=pg.escape_name(td.get_pk_fieldname()),
+            changed=_changed_condition(td, 'src', 'dest'),
+            whendeleted=('WHEN MATCHED AND src."IsDeleted" THEN DELETE'
+                         if has_isdeleted else ''),
+            andnotdeleted='AND NOT src."IsDeleted"' if has_isdeleted else '',
+            )
+    cursor.execute(sql)
+    logger.debug("pg MERGE rowcount: %s", cursor.rowcount)
+    return {'changed': cursor.rowcount}
+
+
+def _pg_upsert(td, staging_tablename, where=None):
+    '''
+    Apply the changes with INSERT ON CONFLICT and DELETE USING, for the
+    versions of PostgreSQL without MERGE
+    Returns the numbers of rows inserted, updated and deleted, in a dict.
+    '''
     logger = logging.getLogger(__name__)
     cursor = pg.cursor()
 
     fieldnames = td.get_sync_field_names()
     has_isdeleted = 'IsDeleted' in fieldnames
     quoted_table_dest = pg.table_name(td.name)
-    quoted_table_src = pg.table_name(tmp_tablename, schema='')
+    quoted_table_src = _source(staging_tablename, where)
     quoted_field_names = ','.join(
             [pg.escape_name(f) for f in fieldnames])
     excluded_quoted_field_names = ','.join(
             ['EXCLUDED.'+pg.escape_name(f) for f in fieldnames])
-    sql = '''INSERT INTO {quoted_table_dest}
-             ( {quoted_field_names} )
-             SELECT {quoted_field_names}
-             FROM {quoted_table_src}
-             {wherenotdeleted}
-             ON CONFLICT ( {id} )
-             DO UPDATE
-                 SET ( {quoted_field_names} )
-                 = ( {excluded_quoted_field_names} )
+    # The rows that were inserted don't have an xmax
+    sql = '''WITH upserted AS (
+                 INSERT INTO {quoted_table_dest} AS dest
+                 ( {quoted_field_names} )
+                 SELECT {quoted_field_names}
+                 FROM {quoted_table_src} src
+                 {wherenotdeleted}
+                 ON CONFLICT ( {id} )
+                 DO UPDATE
+                     SET ( {quoted_field_names} )
+                     = ( {excluded_quoted_field_names} )
+                     WHERE {changed}
+                 RETURNING dest.xmax = 0 AS inserted
+             )
+             SELECT count(*) FILTER (WHERE inserted),
+                    count(*) FILTER (WHERE NOT inserted)
+             FROM upserted
            '''.format(
             quoted_table_dest=quoted_table_dest,
             quoted_table_src=quoted_table_src,
             quoted_field_names=quoted_field_names,
             id=pg.escape_name(td.get_pk_fieldname()),
             excluded_quoted_field_names=excluded_quoted_field_names,
+            changed=_changed_condition(td, 'EXCLUDED', 'dest'),
             wherenotdeleted='WHERE NOT "IsDeleted"' if has_isdeleted else ''
             )
     cursor.execute(sql)
-    logger.info("pg INSERT/UPDATE rowcount: %s", cursor.rowcount)
+    counts = dict(zip(('inserted', 'updated'), cursor.fetchone()))
+    counts['deleted'] = 0
 
     if has_isdeleted:
-        sql = '''DELETE FROM {quoted_table_dest}
-                 WHERE {id} IN (
-                     SELECT {id}
-                     FROM {quoted_table_src}
-                     WHERE "IsDeleted"
-                     )
+        sql = '''DELETE FROM {quoted_table_dest} dest
+                 USING {quoted_table_src} src
+                 WHERE dest.{id} = src.{id}
+                 AND src."IsDeleted"
               '''.format(
               quoted_table_dest=quoted_table_dest,
               quoted_table_src=quoted_table_src,
               id=pg.escape_name(td.get_pk_fieldname()),
               )
         cursor.execute(sql)
-        logger.info("pg DELETE rowcount: %s", cursor.rowcount)
+        counts['deleted'] = cursor.rowcount
+    return counts
 
 
-def sync_table(tablename):
+def pg_merge_update(td, staging_tablename, where=None):
+    '''
+    Apply the changes of the staging table to the table: MERGE is used when
+    the server has it. where is an optional condition on the records of the
+    staging table.
+    The staging table must not have the same record twice: See pg_dedupe.
+    Records that are older than the row of the table, or that don't change
+    it, are skipped.
+    Returns a dict with the number of records of the staging table, and the
+    numbers of rows changed and of records skipped. The numbers of rows
+    inserted, updated and deleted are only there without MERGE, as they come
+    from the statements.
+    '''
     logger = logging.getLogger(__name__)
+    cursor = pg.cursor()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('pg expected changes: %s',
+                     _count_changes(td, staging_tablename, where))
+    cursor.execute('SELECT count(*) FROM {}'.format(
+        _source(staging_tablename, where)))
+    records = cursor.fetchone()[0]
+    if pg.get_conn().server_version >= MERGE_SERVER_VERSION:
+        counts = _pg_merge(td, staging_tablename, where)
+    else:
+        counts = _pg_upsert(td, staging_tablename, where)
+        counts['changed'] = sum(counts.values())
+        logger.info('pg %s inserted, %s updated, %s deleted',
+                    counts['inserted'], counts['updated'], counts['deleted'])
+    counts['records'] = records
+    counts['skipped'] = records - counts['changed']
+    logger.info('pg %s changed, %s skipped', counts['changed'],
+                counts['skipped'])
+    return counts
+
+
+def _get_chunk_bounds(td, staging_tablename, chunk_size):
+    '''
+    Returns the list of the timestamps ending the slices of about chunk_size
+    records of the staging table, in (timestamp, id) order, with the number
+    of records until each of them. All the records with a given timestamp
+    are in the same slice, so that syncuntil can be moved to the end of a
+    slice once it is applied.
+    '''
+    cursor = pg.cursor()
+    timefield = pg.escape_name(td.get_timestamp_name())
+    cursor.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+        pg.escape_name(staging_tablename + '_time_idx'),
+        pg.table_name(staging_tablename),
+        timefield))
+    cursor.execute('''
+        SELECT {timefield}, max(rank)
+        FROM (
+            SELECT {timefield},
+                   row_number() OVER (ORDER BY {timefield}, {id}) AS rank
+            FROM {quoted_table_src}
+            WHERE {timefield} IS NOT NULL
+            ) ranked
+        GROUP BY {timefield}
+        HAVING bool_or(rank %% %s = 0)
+        ORDER BY 1
+        '''.format(
+            timefield=timefield,
+            id=pg.escape_name(td.get_pk_fieldname()),
+            quoted_table_src=pg.table_name(staging_tablename),
+            ), (chunk_size,))
+    return cursor.fetchall()
 
-    td = TableDesc(tablename)
 
-    synctable.update(td, 'running', required_status='ready')
+def pg_merge_update_chunked(td, staging_tablename, chunk_size):
+    '''
+    Apply the changes of the staging table by slices of about chunk_size
+    records, in timestamp order. Each slice is committed with syncuntil set
+    to its end, so that after a failure, the next run starts from there.
+    The staging table must be committed first, and the lock of the table
+    held, so that no other run changes the staging table meanwhile.
+    Returns the same dict as pg_merge_update. An exception is raised before
+    committing a slice that doesn't have the expected number of records.
+    '''
+    logger = logging.getLogger(__name__)
+    cursor = pg.cursor()
+    cursor.execute('SELECT count(*) FROM {}'.format(
+        pg.table_name(staging_tablename)))
+    staged = cursor.fetchone()[0]
+    timefield = pg.escape_name(td.get_timestamp_name())
+    bounds = _get_chunk_bounds(td, staging_tablename, chunk_size)
+    logger.info('Applying in %s chunks', len(bounds) + 1)
+
+    totals = collections.Counter()
+    begin = None
+    applied = 0
+    for end, until in bounds + [(None, staged)]:
+        conditions = []
+        if begin is not None:
+            conditions.append('{} > {}'.format(
+                timefield, pg.escape_str(str(begin))))
+        if end is not None:
+            conditions.append('{} <= {}'.format(
+                timefield, pg.escape_str(str(end))))
+        if begin is not None and end is None:
+            # The records without timestamp are in the last slice
+            where = '({} OR {} IS NULL)'.format(conditions[0], timefield)
+        else:
+            where = ' AND '.join(conditions) or 'TRUE'
+
+        step = time.time()
+        counts = pg_merge_update(td, staging_tablename, where)
+        totals.update(counts)
+        if counts['records'] != until - applied:
+            raise RuntimeError(
+                'Expected {} records in {} after {}, found {}'.format(
+                    until - applied, staging_tablename, begin,
+                    counts['records']))
+        applied = until
+        if end is not None:
+            # That commits
+            synctable.update(td, 'running', syncuntil=end)
+            logger.info('Applied changes until %s in %.1f s',
+                        end, time.time() - step)
+        begin = end
+    return totals
+
+
+def get_staging_syncuntil(td, staging_tablename):
+    '''
+    Returns the time of the last change in the staging table, or None if it
+    is empty. Deleted records are included, so that they are not fetched
+    again.
+    '''
+    cursor = pg.cursor()
+    cursor.execute('SELECT max({}) FROM {}'.format(
+        pg.escape_name(td.get_timestamp_name()),
+        pg.table_name(staging_tablename)))
+    return cursor.fetchone()[0]
 
-    try:
-        csvfilename = download_changes(td)
 
-        if csvfilename is None:
-            logger.info('No change in table %s', tablename)
+def pg_dedupe(td, staging_tablename):
+    '''
+    Remove the older versions of the records that are several times in
+    staging_tablename, keeping the one with the latest timestamp. Records
+    without timestamp are older than the others.
+    '''
+    logger = logging.getLogger(__name__)
+    cursor = pg.cursor()
+    sql = '''DELETE FROM {quoted_table_src} a
+             USING {quoted_table_src} b
+             WHERE a.{id} = b.{id}
+             AND (COALESCE(a.{timefield}, '-infinity'), a.ctid)
+                 < (COALESCE(b.{timefield}, '-infinity'), b.ctid)
+          '''.format(
+            quoted_table_src=pg.table_name(staging_tablename),
+            id=pg.escape_name(td.get_pk_fieldname()),
+            timefield=pg.escape_name(td.get_timestamp_name()),
+            )
+    cursor.execute(sql)
+    logger.info("pg duplicates DELETE rowcount: %s", cursor.rowcount)
 
-            synctable.update(td, 'ready', update_last_refresh=True)
 
+def _get_columns(tablename):
+    '''
+    Returns the list of (name, type) of the columns of a table, or an empty
+    list if it doesn't exist.
+    '''
+    cursor = pg.cursor()
+    cursor.execute('''
+        SELECT attname, format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = to_regclass(%s)
+        AND attnum > 0
+        AND NOT attisdropped
+        ORDER BY attnum
+        ''', (pg.table_name(tablename),))
+    return cursor.fetchall()
+
+
+def get_staging_table(td):
+    '''
+    Returns the name of the UNLOGGED staging table of a table, where the
+    changes are copied before being applied. It is kept between runs, and
+    only created again when the columns of the table changed.
+    '''
+    logger = logging.getLogger(__name__)
+    staging_tablename = td.name + STAGING_SUFFIX
+    quoted_staging = pg.table_name(staging_tablename)
+    cursor = pg.cursor()
+    if _get_columns(staging_tablename) == _get_columns(td.name):
+        cursor.execute('SELECT 1 FROM {} LIMIT 1'.format(quoted_staging))
+        if cursor.fetchone() is not None:
+            # A chunked apply failed
+            logger.warning('Discarding the previous changes of %s',
+                           staging_tablename)
+            cursor.execute('TRUNCATE TABLE {}'.format(quoted_staging))
+        return staging_tablename
+
+    logger.info('Creating staging table %s', staging_tablename)
+    cursor.execute('DROP TABLE IF EXISTS {}'.format(quoted_staging))
+    cursor.execute('CREATE UNLOGGED TABLE {} ( LIKE {} )'.format(
+        quoted_staging, pg.table_name(td.name)))
+    cursor.execute('CREATE INDEX {} ON {} ({})'.format(
+        pg.escape_name(staging_tablename + '_idx'),
+        quoted_staging,
+        pg.escape_name(td.get_pk_fieldname())))
+    return staging_tablename
+
+
+def _copy_changes_rest(td, lastsync, staging_tablename, tee, binary,
+                       workers, count=None):
+    '''
+    Stream the changes from the REST API into the empty staging table.
+    count is the number of changes, if it is already known.
+    Returns the number of rows.
+    '''
+    logger = logging.getLogger(__name__)
+
+    records = query_changes_since(
+            td, lastsync, workers, tuples=True, count=count)
+    first_record = next(records, None)
+    if first_record is None:
+        return 0
+
+    cursor = pg.cursor()
+
+    if binary:
+        encoder = BinaryEncoder(td, tuples=True)
+    else:
+        encoder = CsvEncoder(td, tuples=True)
+    sql = get_pgsql_copy(
+            td, encoder.fieldnames, staging_tablename,
+            binary=encoder.binary)
+    records = itertools.chain([first_record], records)
+    if tee:
+        if binary:
+            filename = create_csv_query_file(td.name, 'pgcopy')
+            output = open(filename, 'wb')
         else:
-            cursor = pg.cursor()
+            filename = create_csv_query_file(td.name)
+            output = open(filename, 'w')
+        logger.debug('Saving a copy in %s', filename)
+    else:
+        output = None
+    try:
+        cursor.copy_expert(
+                sql, CopyStream(records, encoder, output))
+    finally:
+        if output is not None:
+            output.close()
+    logger.info("pg COPY rowcount: %s", cursor.rowcount)
+    return cursor.rowcount
 
-            logger.debug('Downloaded to %s', csvfilename)
 
-            tmp_tablename = 'tmp_' + tablename
-            sql = 'CREATE TEMPORARY TABLE {} ( LIKE {} )'.format(
-                pg.table_name(tmp_tablename, schema=''),
-                pg.table_name(tablename))
+def _copy_changes_bulk(td, lastsync, staging_tablename):
+    '''
+    Run a bulk query of the changes, and load it into the staging table.
+    Returns the number of rows.
+    '''
+    logger = logging.getLogger(__name__)
 
-            cursor.execute(sql)
+    where = _changes_where(td, lastsync)
+    if config.BULK_ENGINE == 'bulk2':
+        job = bulk2.create_query_job(td, where=where, include_deleted=True)
+        logger.info('Created job %s', job)
+        rows, job_status = bulk2.run_job(
+                td, job, target_tablename=staging_tablename)
+    else:
+        # PK chunking would scan the whole table, for a fraction of the rows
+        job = make_query(
+                td, where=where, pk_chunking=False, include_deleted=True)
+        logger.info('Created job %s', job)
+        rows, job_status = refresh.run_job(
+                td, job, target_tablename=staging_tablename)
+    return rows
+
+
+def sync_table(tablename, tee=False, binary=config.COPY_BINARY, td=None,
+               workers=config.DELTA_WORKERS,
+               chunk_size=config.APPLY_CHUNK_SIZE):
+    '''
+    Copy the changes of a table from salesforce to postgres.
+    The records are streamed into COPY, in csv or binary format. If tee is
+    set, that stream is also saved in a file in JOB_DIR.
+    td is an optional TableDesc of tablename, to reuse its caches.
+    If workers is more than 1, large backlogs are fetched in parallel.
+    If there are more than BULK_THRESHOLD changes, they are fetched with a
+    bulk query instead.
+    If chunk_size is set, and there are more changes than that, they are
+    applied and committed by slices of chunk_size records: See
+    pg_merge_update_chunked.
+    That holds the lock of the table: If the table is already being
+    synchronized or reloaded by another process, nothing is done, and False
+    is returned. Otherwise returns True.
+    '''
+    logger = logging.getLogger(__name__)
+
+    if td is None:
+        td = TableDesc(tablename)
+
+    # The staging table is shared by the runs of a table
+    if not synctable.lock(tablename, wait=False):
+        pg.commit()  # Don't stay idle in transaction
+        logger.info('Skipping %s: It is already being synchronized or'
+                    ' reloaded', tablename)
+        return False
+    try:
+        _sync_table(td, tee, binary, workers, chunk_size)
+    finally:
+        synctable.unlock(tablename)
+    return True
+
+
+def _sync_table(td, tee, binary, workers, chunk_size):
+    '''
+    Body of sync_table, that runs with the lock of the table
+    '''
+    logger = logging.getLogger(__name__)
+    tablename = td.name
 
-            sql = get_pgsql_import(td, csvfilename, tmp_tablename, schema='')
-            with open(csvfilename) as file:
-                cursor.copy_expert(sql, file)
-                logger.info("pg COPY rowcount: %s", cursor.rowcount)
+    synctable.update(td, 'running', required_status='ready')
 
-            pg_merge_update(td, tmp_tablename)
+    start = time.time()
+    try:
+        lastsync = get_syncuntil(td)
+        method = 'rest'
+        count = None
+        if lastsync is not None and config.BULK_THRESHOLD > 0:
+            count = query_count(
+                    _changes_soql(td, 'COUNT()', lastsync),
+                    include_deleted=True)
+            logger.info('%s changes in %s', count, tablename)
+            if count is not None and count >= config.BULK_THRESHOLD:
+                method = 'bulk'
+
+        if lastsync is None:
+            rows = 0
+        else:
+            staging_tablename = get_staging_table(td)
+            step = time.time()
+            if method == 'bulk':
+                rows = _copy_changes_bulk(td, lastsync, staging_tablename)
+            else:
+                rows = _copy_changes_rest(
+                        td, lastsync, staging_tablename, tee, binary,
+                        workers, count)
+            logger.info('Copied %s changes in %.1f s',
+                        rows, time.time() - step)
+
+        if not rows:
+            logger.info('No change in table %s', tablename)
 
-            sql = 'DROP TABLE {}'.format(
-                pg.table_name(tmp_tablename, schema=''))
-            cursor.execute(sql)
+            synctable.update(td, 'ready', update_last_refresh=True,
+                             method=method, duration=time.time() - start)
 
+        else:
+            step = time.time()
+            pg_dedupe(td, staging_tablename)
+            logger.info('Deduplicated in %.1f s', time.time() - step)
+
+            step = time.time()
+            if chunk_size and rows > chunk_size:
+                # The other slices must see the staging table after a
+                # failure
+                pg.commit()
+                pg_merge_update_chunked(td, staging_tablename, chunk_size)
+            else:
+                pg_merge_update(td, staging_tablename)
+            logger.info('Applied in %.1f s', time.time() - step)
+
+            syncuntil = get_staging_syncuntil(td, staging_tablename)
+
+            step = time.time()
+            pg.cursor().execute('TRUNCATE TABLE {}'.format(
+                pg.table_name(staging_tablename)))
+            logger.info('Truncated staging in %.1f s', time.time() - step)
+
+            # Committed with the changes
             synctable.update(
                     td, 'ready',
-                    update_syncuntil=True,
-                    update_last_refresh=True)
+                    syncuntil=syncuntil,
+                    update_last_refresh=True,
+                    method=method,
+                    duration=time.time() - start)
 
             pg.commit()
+        logger.info('Synchronized %s: %s changes through %s in %.1f s',
+                    tablename, rows, method, time.time() - start)
     except Exception:
         # Re-raise exception, so that stderr as a message
         # cron will mail it
         # TODO: detect some errors like a column that disapeared
+        pg.get_conn().rollback()
         synctable.update(td, 'ready')
         raise
 
@@ -208,6 +872,27 @@ if __name__ == '__main__':
     def main():
         parser = argparse.ArgumentParser(
             description='Refresh a table from salesforce to postgres')
+        parser.add_argument(
+                '--tee',
+                action='store_true',
+                help='also save the changes in a csv file in job_dir')
+        parser.add_argument(
+                '--binary',
+                action='store_true',
+                default=config.COPY_BINARY,
+                help='use binary COPY format')
+        parser.add_argument(
+                '--workers',
+                type=int,
+                default=config.DELTA_WORKERS,
+                help='number of parallel queries for large backlogs.'
+                     ' default=%(default)s')
+        parser.add_argument(
+                '--chunk-size',
+                type=int,
+                default=config.APPLY_CHUNK_SIZE,
+                help='apply and commit large backlogs by chunks of that'
+                     ' number of records. 0 disables. default=%(default)s')
         parser.add_argument(
                 'table',
                 help='the table name to refresh')
@@ -218,6 +903,10 @@ if __name__ == '__main__':
                 format=config.LOGFORMAT.format('query_poll_table '+args.table),
                 level=config.LOGLEVEL)
 
-        sync_table(args.table)
+        if not sync_table(args.table, tee=args.tee, binary=args.binary,
+                          workers=args.workers, chunk_size=args.chunk_size):
+            print('{} is already being synchronized or reloaded'.format(
+                args.table), file=sys.stderr)
+            sys.exit(1)
 
     main()
@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+'''
+Full refresh of a table.
+That runs query_bulk, download and csv_to_postgres as a pipeline: Batches are
+downloaded as soon as Salesforce completes them, and copied into PostgreSQL
+while the other batches are still being processed.
+'''
+
+import argparse
+import logging
+import os
+import queue
+import threading
+from time import sleep, time
+
+import requests
+
+import bulk2
+import config
+import download
+import pg
+import shadowtable
+import synctable
+from abort_refresh import kill_refresh
+from csv_to_postgres import get_pgsql_import
+from query_bulk import make_query
+from salesforce import get_SalesforceBulk
+from salesforce_bulk import bulk_states
+from salesforce_bulk.salesforce_bulk import BulkBatchFailed
+from tabledesc import TableDesc
+
+# Maximum number of items waiting between two stages of the pipeline
+DEFAULT_QUEUE_SIZE = 4
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stage in the queues
+_DONE = None
+
+
+class _Pipeline:
+    '''
+    Threads and queues of a refresh:
+    watch_batches -> download_queue -> download_worker(s) -> load_queue -> load
+    The queues are bounded, so that a slow stage blocks the previous one.
+    '''
+    def __init__(self, bulk, job, content_type, workers, queue_size):
+        self.bulk = bulk
+        self.job = job
+        self.content_type = content_type
+        self.workers = workers
+        self.download_queue = queue.Queue(maxsize=queue_size)
+        self.load_queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.errors = []
+
+    def fail(self, exc):
+        '''
+        Record an error and stop all the stages
+        '''
+        logger.error('Refresh failed: %s', exc)
+        self.errors.append(exc)
+        self.stop.set()
+
+    def put(self, que, item):
+        '''
+        Blocking put, unless the pipeline is stopped
+        '''
+        while not self.stop.is_set():
+            try:
+                que.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, que):
+        '''
+        Blocking get. Returns _DONE if the pipeline is stopped.
+        '''
+        while True:
+            try:
+                return que.get(timeout=1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return _DONE
+
+    def watch_batches(self, pool_time):
+        '''
+        Poll the job and queue each batch once it is completed
+        '''
+        dispatched = set()
+        try:
+            while not self.stop.is_set():
+                try:
+                    # Status is read first, so that when nothing is queued
+                    # anymore, the batch list has all the completed batches.
+                    job_status = self.bulk.job_status(self.job)
+                    batches = self.bulk.get_batch_list(self.job)
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout):
+                    # At that point, a connection error is bad, but not fatal
+                    # Let's retry
+                    sleep(pool_time)
+                    continue
+
+                for batch in batches:
+                    batch_id = batch['id']
+                    if batch['state'] in (bulk_states.FAILED,
+                                          bulk_states.ABORTED):
+                        raise BulkBatchFailed(
+                                self.job, batch_id,
+                                batch.get('stateMessage'), batch['state'])
+                    if (batch['state'] == bulk_states.COMPLETED
+                            and batch_id not in dispatched):
+                        dispatched.add(batch_id)
+                        self.put(self.download_queue, batch_id)
+
+                nb_queued = int(job_status['numberBatchesQueued'])
+                nb_inprogress = int(job_status['numberBatchesInProgress'])
+                logger.info(
+                        '%s batch: %s Queued, %s In Progress, %s Completed',
+                        job_status['numberBatchesTotal'], nb_queued,
+                        nb_inprogress, len(dispatched))
+                if nb_queued == 0 and nb_inprogress == 0:
+                    break
+                sleep(pool_time)
+        except Exception as exc:
+            self.fail(exc)
+        finally:
+            for i in range(self.workers):
+                self.put(self.download_queue, _DONE)
+
+    def download_worker(self):
+        '''
+        Download the batches from download_queue, and queue the files for
+        loading
+        '''
+        try:
+            while True:
+                batch_id = self.get(self.download_queue)
+                if batch_id is _DONE:
+                    break
+                logger.debug('Downloading batch %s', batch_id)
+                filename, size = download.download_batch(
+                        self.bulk, self.job, batch_id, self.content_type)
+                logger.debug('Downloaded %s bytes in %s', size, filename)
+                self.put(self.load_queue, filename)
+        except Exception as exc:
+            self.fail(exc)
+        finally:
+            self.put(self.load_queue, _DONE)
+
+    def load(self, td, target_tablename=None, schema=None):
+        '''
+        Copy the downloaded files into the table, or into target_tablename.
+        The table is truncated before the first file. That must run in the
+        thread owning the postgres connection.
+        Returns the number of rows.
+        '''
+        cursor = pg.cursor()
+        sql = None
+        rows = 0
+        running = self.workers
+        while running:
+            filename = self.get(self.load_queue)
+            if filename is _DONE:
+                running -= 1
+                continue
+            if sql is None:
+                sql = 'TRUNCATE TABLE {}'.format(pg.table_name(
+                    target_tablename or td.name, schema=schema))
+                logger.debug(sql)
+                cursor.execute(sql)
+                sql = get_pgsql_import(
+                        td, filename, target_tablename, schema=schema)
+                logger.debug('%s', sql)
+            with open(filename, 'rb') as file:
+                cursor.copy_expert(sql, file)
+            logger.debug('%s: rowcount %s', filename, cursor.rowcount)
+            rows += cursor.rowcount
+        return rows
+
+
+def run_job(td, job,
+            pool_time=5,
+            workers=download.DEFAULT_WORKERS,
+            queue_size=DEFAULT_QUEUE_SIZE,
+            target_tablename=None,
+            schema=None):
+    '''
+    Download the batches of a bulk query job as they are completed, and copy
+    them into the table, or into target_tablename, that is truncated first.
+    The job is closed at the end.
+    Returns the number of rows, and the final job status.
+    '''
+    os.makedirs(config.JOB_DIR + '/' + job, exist_ok=True)
+
+    bulk = get_SalesforceBulk()
+    job_status = bulk.job_status(job)
+    pipeline = _Pipeline(
+            bulk, job, job_status['contentType'], workers, queue_size)
+
+    start = time()
+    threads = [threading.Thread(
+        target=pipeline.watch_batches, args=(pool_time,))]
+    for i in range(workers):
+        threads.append(threading.Thread(target=pipeline.download_worker))
+    for thread in threads:
+        thread.start()
+    try:
+        rows = pipeline.load(td, target_tablename, schema)
+    except BaseException:
+        pipeline.stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if pipeline.errors:
+        raise pipeline.errors[0]
+    elapsed = max(time() - start, 1e-6)
+    logger.info('Loaded %s rows in %.1f s: %.0f rows/s',
+                rows, elapsed, rows / elapsed)
+
+    job_status = bulk.job_status(job)
+    download.save_json(job, 'batches.json', bulk.get_batch_list(job))
+    if job_status['state'] == 'Open':
+        logger.info('Closing job')
+        bulk.close_job(job)
+        job_status = bulk.job_status(job)
+    download.save_json(job, 'status.json', job_status)
+    return rows, job_status
+
+
+def refresh(tablename,
+            where=None,
+            pk_chunking=True,
+            pool_time=5,
+            workers=download.DEFAULT_WORKERS,
+            queue_size=DEFAULT_QUEUE_SIZE,
+            engine=config.BULK_ENGINE):
+    '''
+    Replace the content of a table with a new bulk query.
+    The batches are loaded into a shadow table, that replaces the table once
+    complete, so that readers see the previous data meanwhile, and are only
+    locked out during the swap.
+    engine is 'bulk' or 'bulk2', for Bulk API 2.0, where pk_chunking and
+    queue_size don't apply.
+    '''
+    td = TableDesc(tablename)
+
+    kill_refresh(tablename, sync_check=False)
+    previous_status = synctable.get_status(tablename)
+    if previous_status is not None:
+        synctable.update(td, 'running')
+
+    try:
+        shadow_tablename = shadowtable.shadow_name(tablename)
+        shadowtable.create(tablename)
+        if engine == 'bulk2':
+            job = bulk2.create_query_job(td, where=where)
+            logger.info('Created job %s', job)
+            rows, job_status = bulk2.run_job(
+                    td, job, pool_time=pool_time, workers=workers,
+                    target_tablename=shadow_tablename)
+        else:
+            job = make_query(td, where=where, pk_chunking=pk_chunking)
+            logger.info('Created job %s', job)
+            rows, job_status = run_job(
+                    td, job, pool_time=pool_time, workers=workers,
+                    queue_size=queue_size, target_tablename=shadow_tablename)
+
+        if rows:
+            shadowtable.build_indexes(tablename)
+            pg.commit()
+            shadowtable.swap(tablename)
+        else:
+            logger.critical('%s is empty', tablename)
+            pg.get_conn().rollback()
+
+        synctable.insert(td, job_status['systemModstamp'])
+    except Exception:
+        pg.get_conn().rollback()
+        if previous_status is not None:
+            synctable.update(td, previous_status)
+        raise
+
+
+if __name__ == '__main__':
+    def main():
+        parser = argparse.ArgumentParser(
+            description='Download a full table from salesforce to postgres',
+            epilog='This runs query_bulk, download and csv_to_postgres.'
+                   ' Batches are loaded as soon as they are completed.')
+        parser.add_argument(
+                '--where',
+                help='condition')
+        parser.add_argument(
+                '--pk-chunking',
+                metavar='SIZE',
+                type=int,
+                help='chunk size')
+        parser.add_argument(
+                '--no-pk-chunking',
+                action='store_true',
+                help='disable pk chuncking')
+        parser.add_argument(
+                '--workers',
+                type=int,
+                default=download.DEFAULT_WORKERS,
+                help='number of parallel downloads. default=%(default)s')
+        parser.add_argument(
+                '--queue-size',
+                type=int,
+                default=DEFAULT_QUEUE_SIZE,
+                help='maximum number of batches waiting between download'
+                     ' and load. default=%(default)s')
+        parser.add_argument(
+                '--engine',
+                choices=('bulk', 'bulk2'),
+                default=config.BULK_ENGINE,
+                help='bulk query engine. bulk2 is Bulk API 2.0.'
+                     ' default=%(default)s')
+        parser.add_argument(
+                'table',
+                help='table name')
+        args = parser.parse_args()
+
+        logging.basicConfig(
+                filename=config.LOGFILE,
+                format=config.LOGFORMAT.format('refresh '+args.table),
+                level=config.LOGLEVEL)
+
+        if args.pk_chunking:
+            pk_chunking = args.pk_chunking
+        elif args.no_pk_chunking:
+            pk_chunking = None
+        else:
+            pk_chunking = True
+
+        refresh(args.table,
+                where=args.where,
+                pk_chunking=pk_chunking,
+                workers=args.workers,
+                queue_size=args.queue_size,
+                engine=args.engine)
+
+    main()
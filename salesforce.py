@@ -1,6 +1,29 @@
+'''
+That module creates the Salesforce REST and Bulk clients.
+
+Sessions are cached in a file shared by all the processes, so that a login is
+only needed when the session expires.
+'''
+
+import atexit
+import fcntl
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from os.path import expanduser
+
+import requests
+
 import config
-from salesforce_bulk import SalesforceBulk
-from simple_salesforce import Salesforce
+from salesforce_bulk import SalesforceBulk, BulkApiError
+from simple_salesforce import Salesforce, SFType, SalesforceLogin
+from simple_salesforce.exceptions import SalesforceExpiredSession
+
+logger = logging.getLogger(__name__)
 
 __sf_config = config.get_section('salesforce')
 
@@ -14,13 +37,305 @@ if __val:
 
 SF_API_VERSION = __sf_config['api_version']
 
+HTTP_POOL_SIZE = __sf_config.getint('http_pool_size', 10)
+HTTP_TIMEOUT = (
+        __sf_config.getfloat('connect_timeout', 10),
+        __sf_config.getfloat('read_timeout', 300))
+
+# Disable pretty printing of json responses, and gzip the bulk uploads
+HTTP_COMPRESS = __sf_config.getboolean('compress', True)
+
+SESSION_CACHE = expanduser(
+        __sf_config.get('session_cache', '~/.pgsf_session'))
+# Minutes a cached session is reused. 0 disables the file cache.
+SESSION_TTL = __sf_config.getint('session_ttl', 60)
+
+__session = None
+__http_session = None
+# Threads of a process share the session, and login only once
+__lock = threading.RLock()
+
+
+def get_http_session():
+    '''
+    Returns *the* requests.Session shared by all the Salesforce clients of the
+    process, so that HTTPS connections are kept alive and reused.
+    '''
+    global __http_session
+    with __lock:
+        if __http_session is None:
+            __http_session = SalesforceBulk.create_session(
+                    HTTP_POOL_SIZE, _CountingSession())
+            atexit.register(__http_session.log_stats)
+    return __http_session
+
+
+class _CountingSession(requests.Session):
+    '''
+    requests.Session that counts the bytes of the bodies that are sent and
+    received, both as on the wire, that is compressed, and decoded.
+    Streamed responses are counted as they are read.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += int(request.headers.get('Content-Length', 0))
+        if kwargs.get('stream'):
+            self.__count_stream(response)
+        else:
+            self.__count(response.raw.tell(), len(response.content))
+        return response
+
+    def __count(self, received, decoded):
+        with self.lock:
+            self.bytes_received += received
+            self.bytes_decoded += decoded
+
+    def __count_stream(self, response):
+        iter_content = response.iter_content
+        received = 0
+
+        def counting_iter_content(*args, **kwargs):
+            nonlocal received
+            for chunk in iter_content(*args, **kwargs):
+                self.__count(response.raw.tell() - received, len(chunk))
+                received = response.raw.tell()
+                yield chunk
+        response.iter_content = counting_iter_content
+
+    def log_stats(self):
+        logger.info(
+            'HTTP: %s requests, %.1f kB sent, %.1f kB received'
+            ' (%.1f kB decoded)',
+            self.requests, self.bytes_sent / 1024,
+            self.bytes_received / 1024, self.bytes_decoded / 1024)
+
+
+@contextmanager
+def _session_cache_lock():
+    '''
+    Exclusive lock on the session cache, held during login so that
+    concurrent processes wait for the new session rather than all login.
+    '''
+    with open(SESSION_CACHE + '.lock', 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def _read_session_cache():
+    '''
+    Returns the cached (session_id, instance) tuple, or None if there is no
+    valid entry for the configured account.
+    '''
+    try:
+        with open(SESSION_CACHE) as file:
+            cache = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (cache.get('username') != CREDIDENTIALS['username']
+            or cache.get('domain') != CREDIDENTIALS.get('domain')):
+        return None
+    if time.time() - cache.get('created', 0) > SESSION_TTL * 60:
+        logger.debug('Cached Salesforce session is too old')
+        return None
+    return cache['session_id'], cache['instance']
+
+
+def _write_session_cache(session_id, instance):
+    '''
+    Atomically replace the session cache file. It is only readable by the
+    owner, since it holds a valid session id.
+    '''
+    tmpname = SESSION_CACHE + '.tmp'
+    fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as file:
+        json.dump({
+            'username': CREDIDENTIALS['username'],
+            'domain': CREDIDENTIALS.get('domain'),
+            'session_id': session_id,
+            'instance': instance,
+            'created': time.time(),
+            }, file)
+    os.replace(tmpname, SESSION_CACHE)
+
+
+def _login():
+    logger.info('Login to Salesforce as %s', CREDIDENTIALS['username'])
+    return SalesforceLogin(
+            sf_version=SF_API_VERSION,
+            session=get_http_session(),
+            **CREDIDENTIALS)
+
+
+def get_session(expired_session_id=None):
+    '''
+    Returns a (session_id, instance) tuple.
+    The session is shared with the other processes through SESSION_CACHE.
+    If expired_session_id is set, that session was rejected by Salesforce:
+    a new login is done, unless another process already did it.
+    '''
+    global __session
+    if __session is not None and __session[0] != expired_session_id:
+        return __session
+
+    with __lock:
+        if __session is not None and __session[0] != expired_session_id:
+            # Another thread did the login
+            return __session
+
+        if SESSION_TTL <= 0:
+            __session = _login()
+            return __session
+
+        with _session_cache_lock():
+            session = _read_session_cache()
+            if session is None or session[0] == expired_session_id:
+                session = _login()
+                _write_session_cache(*session)
+            else:
+                logger.debug('Reusing cached Salesforce session')
+        __session = session
+    return __session
+
+
+class _SFType(SFType):
+    '''
+    SFType that logs in again when the session expired
+    '''
+    def __init__(self, object_name, sf):
+        super().__init__(
+                object_name, sf.session_id, sf.sf_instance,
+                sf_version=sf.sf_version, session=sf.session)
+        self.__sf = sf
+
+    def _call_salesforce(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        if HTTP_COMPRESS:
+            # A header set to None is not sent by requests
+            kwargs['headers'] = dict(
+                    kwargs.get('headers') or {}, **{'X-PrettyPrint': None})
+        try:
+            return super()._call_salesforce(method, url, **kwargs)
+        except SalesforceExpiredSession:
+            self.__sf.renew_session()
+            self.session_id = self.__sf.session_id
+        return super()._call_salesforce(method, url, **kwargs)
+
+
+class _Salesforce(Salesforce):
+    '''
+    Salesforce that logs in again when the session expired
+    '''
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if HTTP_COMPRESS:
+            del self.headers['X-PrettyPrint']
+
+    def renew_session(self):
+        logger.info('Salesforce session expired')
+        self.session_id, self.sf_instance = get_session(self.session_id)
+        self.headers['Authorization'] = 'Bearer ' + self.session_id
+
+    def _call_salesforce(self, method, url, name="", **kwargs):
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        try:
+            return super()._call_salesforce(method, url, name=name, **kwargs)
+        except SalesforceExpiredSession:
+            self.renew_session()
+        return super()._call_salesforce(method, url, name=name, **kwargs)
+
+    def query_response(self, query, include_deleted=False, **kwargs):
+        '''
+        Like query, but returns the HTTP response, whose content is not read
+        yet, so that it can be decoded while it is received.
+        '''
+        url = self.base_url + ('queryAll/' if include_deleted else 'query/')
+        return self._call_salesforce(
+                'GET', url, name='query', params={'q': query}, stream=True,
+                **kwargs)
+
+    def query_more_response(self, next_records_url, **kwargs):
+        '''
+        Like query_more with identifier_is_url, but returns the HTTP
+        response, whose content is not read yet.
+        '''
+        url = 'https://{}{}'.format(self.sf_instance, next_records_url)
+        return self._call_salesforce(
+                'GET', url, name='query_more', stream=True, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'bulk':
+            return super().__getattr__(name)
+        return _SFType(name, self)
+
+
+def _renew_bulk_session_on_error(method):
+    '''
+    Decorator for SalesforceBulk methods: On InvalidSessionId errors, get a
+    new session and try again once.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except BulkApiError as exc:
+            if 'InvalidSessionId' not in str(exc):
+                raise
+        logger.info('Salesforce bulk session expired')
+        self.sessionId, _ = get_session(self.sessionId)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _SalesforceBulk(SalesforceBulk):
+    '''
+    SalesforceBulk that logs in again when the session expired
+    '''
+    abort_job = _renew_bulk_session_on_error(SalesforceBulk.abort_job)
+    batch_status = _renew_bulk_session_on_error(SalesforceBulk.batch_status)
+    close_job = _renew_bulk_session_on_error(SalesforceBulk.close_job)
+    create_job = _renew_bulk_session_on_error(SalesforceBulk.create_job)
+    get_batch_list = _renew_bulk_session_on_error(
+            SalesforceBulk.get_batch_list)
+    get_batch_results = _renew_bulk_session_on_error(
+            SalesforceBulk.get_batch_results)
+    get_query_batch_result_ids = _renew_bulk_session_on_error(
+            SalesforceBulk.get_query_batch_result_ids)
+    get_query_batch_results = _renew_bulk_session_on_error(
+            SalesforceBulk.get_query_batch_results)
+    job_status = _renew_bulk_session_on_error(SalesforceBulk.job_status)
+    query = _renew_bulk_session_on_error(SalesforceBulk.query)
+    write_query_batch_results = _renew_bulk_session_on_error(
+            SalesforceBulk.write_query_batch_results)
+
 
 def get_Salesforce():
-    params = {}
-    params.update(CREDIDENTIALS)
-    params['version'] = SF_API_VERSION
-    return Salesforce(**params)
+    session_id, instance = get_session()
+    return _Salesforce(
+            session_id=session_id,
+            instance=instance,
+            version=SF_API_VERSION,
+            session=get_http_session(),
+            domain=CREDIDENTIALS.get('domain', None))
 
 
 def get_SalesforceBulk():
-    return SalesforceBulk(**CREDIDENTIALS)
+    session_id, instance = get_session()
+    return _SalesforceBulk(
+            sessionId=session_id,
+            host=instance,
+            session=get_http_session(),
+            timeout=HTTP_TIMEOUT,
+            compress=HTTP_COMPRESS)
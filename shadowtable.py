@@ -0,0 +1,155 @@
+'''
+That module handles the shadow tables used for full reloads.
+
+A shadow table is an UNLOGGED copy of the structure of a table, without
+indexes, where the data is loaded while readers still use the live table.
+Then the indexes are built at once, the table is made LOGGED, and it replaces
+the live table in a single short transaction, with the same privileges.
+'''
+
+import logging
+from time import time
+
+import pg
+
+# Suffix of the shadow tables, and of their indexes before the swap
+SHADOW_SUFFIX = '__shadow'
+
+# PostgreSQL truncates longer names
+NAME_MAX_LENGTH = 63
+
+
+def shadow_name(name):
+    '''
+    Returns the name of the shadow of a table or of an index
+    '''
+    return name[:NAME_MAX_LENGTH - len(SHADOW_SUFFIX)] + SHADOW_SUFFIX
+
+
+def _regclass(tablename):
+    return pg.escape_str(pg.table_name(tablename))
+
+
+def create(tablename):
+    '''
+    Create the empty shadow of a table, dropping any previous one.
+    It has the columns, defaults and constraints of the table, but no index.
+    '''
+    logger = logging.getLogger(__name__)
+    cursor = pg.cursor()
+    shadow = pg.table_name(shadow_name(tablename))
+    sql = 'DROP TABLE IF EXISTS {}'.format(shadow)
+    logger.debug(sql)
+    cursor.execute(sql)
+    sql = '''CREATE UNLOGGED TABLE {} (LIKE {}
+             INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)
+          '''.format(shadow, pg.table_name(tablename))
+    logger.debug(sql)
+    cursor.execute(sql)
+
+
+def _get_indexes(tablename):
+    '''
+    Returns the list of (index name, constraint definition, index definition)
+    of a table. The constraint definition is None for plain indexes.
+    '''
+    cursor = pg.cursor()
+    cursor.execute('''
+        SELECT index_class.relname,
+               pg_get_constraintdef(con.oid),
+               pg_get_indexdef(ind.indexrelid),
+               ind.indisunique
+        FROM pg_index ind
+        JOIN pg_class index_class ON index_class.oid = ind.indexrelid
+        LEFT JOIN pg_constraint con ON con.conindid = ind.indexrelid
+                                   AND con.conrelid = ind.indrelid
+        WHERE ind.indrelid = {}::regclass
+        ORDER BY ind.indisprimary DESC, index_class.relname
+        '''.format(_regclass(tablename)))
+    result = []
+    for name, constraintdef, indexdef, unique in cursor.fetchall():
+        if constraintdef is None:
+            # Keep "USING method (columns) ..."
+            indexdef = 'CREATE {}INDEX {{}} ON {{}}{}'.format(
+                    'UNIQUE ' if unique else '',
+                    indexdef[indexdef.index(' USING '):])
+        result.append((name, constraintdef, indexdef))
+    return result
+
+
+def build_indexes(tablename):
+    '''
+    Create the indexes of the table on its shadow, under temporary names,
+    and make the shadow LOGGED.
+    '''
+    logger = logging.getLogger(__name__)
+    cursor = pg.cursor()
+    shadow = pg.table_name(shadow_name(tablename))
+    for name, constraintdef, indexdef in _get_indexes(tablename):
+        start = time()
+        if constraintdef is not None:
+            sql = 'ALTER TABLE {} ADD CONSTRAINT {} {}'.format(
+                    shadow, pg.escape_name(shadow_name(name)), constraintdef)
+        else:
+            sql = indexdef.format(pg.escape_name(shadow_name(name)), shadow)
+        logger.debug(sql)
+        cursor.execute(sql)
+        logger.info('Built %s in %.1f s', name, time() - start)
+
+    start = time()
+    cursor.execute('ALTER TABLE {} SET LOGGED'.format(shadow))
+    logger.info('Set %s logged in %.1f s', tablename, time() - start)
+
+
+def _get_grants(tablename):
+    '''
+    Returns the list of (grantee, privilege) of a table, but the owner's.
+    '''
+    cursor = pg.cursor()
+    cursor.execute('''
+        SELECT CASE WHEN acl.grantee = 0 THEN 'PUBLIC'
+                    ELSE quote_ident(pg_get_userbyid(acl.grantee)) END,
+               acl.privilege_type
+        FROM pg_class, aclexplode(pg_class.relacl) acl
+        WHERE pg_class.oid = {}::regclass
+        AND acl.grantee <> pg_class.relowner
+        '''.format(_regclass(tablename)))
+    return cursor.fetchall()
+
+
+def swap(tablename):
+    '''
+    Replace the table by its shadow, with the same privileges and index
+    names. That is not committed, so that the sync information can be
+    updated in the same transaction.
+    '''
+    logger = logging.getLogger(__name__)
+    cursor = pg.cursor()
+    table = pg.table_name(tablename)
+    shadow = pg.table_name(shadow_name(tablename))
+    start = time()
+
+    indexes = _get_indexes(tablename)
+    for grantee, privilege in _get_grants(tablename):
+        cursor.execute('GRANT {} ON {} TO {}'.format(
+            privilege, shadow, grantee))
+
+    sql = 'DROP TABLE {}'.format(table)
+    logger.debug(sql)
+    cursor.execute(sql)
+    sql = 'ALTER TABLE {} RENAME TO {}'.format(
+            shadow, pg.escape_name(tablename))
+    logger.debug(sql)
+    cursor.execute(sql)
+    for name, constraintdef, indexdef in indexes:
+        if constraintdef is not None:
+            # That renames the index too
+            sql = 'ALTER TABLE {} RENAME CONSTRAINT {} TO {}'.format(
+                    table, pg.escape_name(shadow_name(name)),
+                    pg.escape_name(name))
+        else:
+            sql = 'ALTER INDEX {} RENAME TO {}'.format(
+                    pg.table_name(shadow_name(name)), pg.escape_name(name))
+        logger.debug(sql)
+        cursor.execute(sql)
+    logger.info('Swapped %s in %.1f s', tablename, time() - start)
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+'''
+Long running replacement for the sync script.
+The tables that are due in __sync are run by query_poll_table.sync_table in a
+bounded pool of threads, most urgent first. The threads share the Salesforce
+session and keep their PostgreSQL connection and their TableDesc.
+'''
+
+import argparse
+import logging
+import signal
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import config
+import pg
+from query_poll_table import sync_table
+from tabledesc import TableDesc
+
+# Maximum number of tables synchronized at the same time
+DEFAULT_WORKERS = config.get_section().getint('sync_workers', 4)
+
+# Seconds between two checks of __sync
+DEFAULT_INTERVAL = 30
+
+# Seconds before a table that failed is tried again
+RETRY_DELAY = 300
+
+logger = logging.getLogger(__name__)
+
+
+def get_due_tables():
+    '''
+    Returns the list of the tables that should be synchronized now.
+    Highest priority first, then the ones that are late the most.
+    '''
+    cursor = pg.cursor()
+    cursor.execute('''
+        SELECT tablename
+        FROM {}
+        WHERE status='ready'
+        AND last_refresh + refresh_minutes * interval '1 minute'
+            < current_timestamp at time zone 'utc'
+        ORDER BY priority DESC,
+                 last_refresh + refresh_minutes * interval '1 minute'
+        '''.format(pg.table_name('__sync')))
+    result = [row[0] for row in cursor]
+    pg.commit()  # Don't stay idle in transaction
+    return result
+
+
+class _Scheduler:
+    '''
+    Runs the due tables in a thread pool, never twice the same one at once.
+    '''
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='sync')
+        self.running = {}  # future -> tablename
+        self.tabledescs = {}  # tablename -> (TableDesc, creation time)
+        self.retry_after = {}  # tablename -> time of the next attempt
+        self.failures = {}  # tablename -> traceback of the last failure
+        self.stop = threading.Event()
+
+    def get_tabledesc(self, tablename):
+        '''
+        Returns the TableDesc of a table, reusing the previous one for
+        METADATA_TTL minutes, so that mapping changes are seen eventually.
+        '''
+        td, created = self.tabledescs.get(tablename, (None, 0))
+        if td is None or time.time() - created > config.METADATA_TTL * 60:
+            td = TableDesc(tablename)
+            self.tabledescs[tablename] = td, time.time()
+        return td
+
+    def sync(self, tablename, td):
+        '''
+        Synchronize one table. Runs in a worker thread.
+        '''
+        threading.current_thread().name = tablename
+        start = time.time()
+        try:
+            synced = sync_table(tablename, td=td)
+        except Exception:
+            logger.exception('Synchronization of %s failed', tablename)
+            self.retry_after[tablename] = time.time() + RETRY_DELAY
+            self.failures[tablename] = traceback.format_exc()
+            # Don't leave the thread connection in a failed transaction
+            pg.get_conn().rollback()
+        else:
+            # When skipped, sync_table logged why
+            if synced:
+                logger.debug('%s synchronized in %.1f s',
+                             tablename, time.time() - start)
+
+    def wait_any(self, timeout):
+        '''
+        Wait until a worker is done, for at most timeout seconds
+        '''
+        if self.running:
+            done, not_done = wait(
+                    self.running, timeout=timeout,
+                    return_when=FIRST_COMPLETED)
+            for future in done:
+                del self.running[future]
+        else:
+            self.stop.wait(timeout)
+
+    def schedule(self):
+        '''
+        Start as many due tables as there are idle workers.
+        Tables are only submitted when a worker is free, so that the order
+        is decided with fresh data.
+        '''
+        idle = self.workers - len(self.running)
+        if idle <= 0:
+            return
+        busy = set(self.running.values())
+        for tablename in get_due_tables():
+            if idle <= 0:
+                break
+            if tablename in busy:
+                continue
+            if self.retry_after.get(tablename, 0) > time.time():
+                continue
+            td = self.get_tabledesc(tablename)
+            future = self.executor.submit(self.sync, tablename, td)
+            self.running[future] = tablename
+            idle -= 1
+
+    def run(self, interval, once=False):
+        '''
+        Main loop. If once is set, only the tables that are due when
+        starting are synchronized.
+        '''
+        if once:
+            tablenames = get_due_tables()
+            logger.info('%s tables to synchronize', len(tablenames))
+            for tablename in tablenames:
+                td = self.get_tabledesc(tablename)
+                self.executor.submit(self.sync, tablename, td)
+        else:
+            while not self.stop.is_set():
+                try:
+                    self.schedule()
+                except Exception:
+                    # Probably a database problem. Retry later.
+                    logger.exception('Scheduling failed')
+                    pg.get_conn().rollback()
+                self.wait_any(interval)
+            logger.info('Stopping: waiting for %s running tables',
+                        len(self.running))
+        self.executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    def main():
+        parser = argparse.ArgumentParser(
+            description='Keep the tables synchronized from salesforce to'
+                        ' postgres')
+        parser.add_argument(
+                '--workers',
+                type=int,
+                default=DEFAULT_WORKERS,
+                help='maximum number of tables synchronized at the same'
+                     ' time. default=%(default)s')
+        parser.add_argument(
+                '--interval',
+                type=float,
+                default=DEFAULT_INTERVAL,
+                help='seconds between two checks of the due tables.'
+                     ' default=%(default)s')
+        parser.add_argument(
+                '--once',
+                action='store_true',
+                help='synchronize the tables that are due, and exit')
+        args = parser.parse_args()
+
+        logging.basicConfig(
+                filename=config.LOGFILE,
+                format=config.LOGFORMAT.format('sync %(threadName)s'),
+                level=config.LOGLEVEL)
+
+        scheduler = _Scheduler(args.workers)
+
+        def on_signal(signum, frame):
+            logger.info('Received signal %s', signum)
+            scheduler.stop.set()
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
+        scheduler.run(args.interval, once=args.once)
+
+        if args.once and scheduler.failures:
+            # Like the sync script used to do, so that cron will mail it
+            for tablename, trace in sorted(scheduler.failures.items()):
+                print('Synchronization of {} failed:'.format(tablename),
+                      file=sys.stderr)
+                print(trace, file=sys.stderr)
+            sys.exit(1)
+
+    main()
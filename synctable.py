@@ -29,11 +29,43 @@ def get_status(tablename):
     return line[0]
 
 
+def lock(tablename, wait=True):
+    '''
+    Take the lock of a table, held by the processes that change its content
+    so that they never run at the same time. That is a session lock: It is
+    kept across transactions, until unlock or until the connection is closed.
+    If wait is False, returns whether the lock could be taken at once.
+    '''
+    cursor = pg.cursor()
+    if wait:
+        cursor.execute('SELECT pg_advisory_lock(hashtext(%s))',
+                       (pg.table_name(tablename),))
+        return True
+    cursor.execute('SELECT pg_try_advisory_lock(hashtext(%s))',
+                   (pg.table_name(tablename),))
+    return cursor.fetchone()[0]
+
+
+def unlock(tablename):
+    '''
+    Release the lock of a table, taken by lock. That commits, so that the
+    connection doesn't stay idle in transaction.
+    '''
+    cursor = pg.cursor()
+    cursor.execute('SELECT pg_advisory_unlock(hashtext(%s))',
+                   (pg.table_name(tablename),))
+    pg.commit()
+
+
 def update(td, newstatus,
-           update_syncuntil=False, update_last_refresh=False,
-           required_status=None):
+           syncuntil=None, update_last_refresh=False,
+           required_status=None, method=None, duration=None):
     """
     Update table salesforce.__sync
+    If syncuntil is set, syncuntil is moved forward to that time. It is
+    never moved backward.
+    method ('rest' or 'bulk') and duration, in seconds, describe the last
+    synchronization.
     """
     logger = logging.getLogger(__name__)
 
@@ -42,18 +74,15 @@ def update(td, newstatus,
     field_updates = {
             'status': pg.escape_str(newstatus)
             }
-    if update_syncuntil:
-        timefield = td.get_timestamp_name()
-        field_updates['syncuntil'] = '''
-            (
-            SELECT max({timefield})
-            FROM {quoted_table_dest}
-            )'''.format(
-                    timefield=pg.escape_name(timefield),
-                    quoted_table_dest=pg.table_name(td.name),
-                )
+    if syncuntil is not None:
+        field_updates['syncuntil'] = 'GREATEST(syncuntil, {})'.format(
+                pg.escape_str(str(syncuntil)))
     if update_last_refresh:
         field_updates['last_refresh'] = "current_timestamp at time zone 'UTC'"
+    if method is not None:
+        field_updates['last_method'] = pg.escape_str(method)
+    if duration is not None:
+        field_updates['last_duration'] = '{:.3f}'.format(duration)
 
     sync_name = pg.table_name('__sync')
     updates = ','.join([f'{key}={value}'
@@ -4,12 +4,17 @@ import argparse
 import csv
 import json
 import logging
+import os
+import tempfile
+import time
 from collections import OrderedDict
+from email.utils import formatdate
 
 import config
 import pg
 import query
-from salesforce import get_Salesforce
+from salesforce import SF_API_VERSION, get_Salesforce
+from simple_salesforce.exceptions import SalesforceGeneralError
 
 logger = logging.getLogger(__name__)
 
@@ -21,33 +26,97 @@ class TableDesc:
         self.__sf_field_definition_cache = None
         self.__fields_cache = None
 
+    def get_metadata_cache_filename(self):
+        '''
+        Returns the name of the file where salesforce metadata is cached
+        '''
+        return '{}/{}_{}.json'.format(
+                config.CACHE_DIR, self.name, SF_API_VERSION)
+
+    def __load_metadata(self):
+        '''
+        Load the description and the field definition from the disk cache.
+        Cached data is used without any check for METADATA_TTL minutes.
+        After that, it is revalidated with a describe If-Modified-Since, and
+        downloaded again only if the object changed.
+        '''
+        filename = self.get_metadata_cache_filename()
+        try:
+            with open(filename) as file:
+                cache = json.load(file)
+        except (FileNotFoundError, ValueError):
+            cache = None
+
+        now = time.time()
+        if cache and now - cache['checked'] < config.METADATA_TTL * 60:
+            logger.debug('Using cached metadata for %s', self.name)
+        else:
+            if cache:
+                headers = {
+                    'If-Modified-Since': formatdate(
+                        cache['downloaded'], usegmt=True)}
+            else:
+                headers = None
+            sf = get_Salesforce()
+            accessor = sf.__getattr__(self.name)
+            try:
+                sf_desc = accessor.describe(headers=headers)
+            except SalesforceGeneralError as exc:
+                if exc.status != 304:
+                    raise
+                logger.debug('Metadata of %s is unchanged', self.name)
+                cache['checked'] = now
+            else:
+                logger.debug('Downloaded metadata of %s', self.name)
+                cache = {
+                    'downloaded': now,
+                    'checked': now,
+                    'desc': sf_desc,
+                    'field_definition': self.__download_field_definition(),
+                    }
+            os.makedirs(config.CACHE_DIR, exist_ok=True)
+            # Other processes may write the same file at the same time
+            fd, tmpname = tempfile.mkstemp(
+                    dir=config.CACHE_DIR,
+                    prefix=os.path.basename(filename) + '.')
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    json.dump(cache, file)
+                os.replace(tmpname, filename)
+            except BaseException:
+                os.unlink(tmpname)
+                raise
+
+        self.__sf_desc_cache = cache['desc']
+        self.__sf_field_definition_cache = cache['field_definition']
+
     def get_sf_desc(self):
         '''
         Connects to saleforce and return raw description.
-        Data is cached for reuse.
+        Data is cached for reuse, in memory and on disk.
         '''
         if self.__sf_desc_cache is None:
-            sf = get_Salesforce()
-            accessor = sf.__getattr__(self.name)
-            self.__sf_desc_cache = accessor.describe()
+            self.__load_metadata()
         return self.__sf_desc_cache
 
+    def __download_field_definition(self):
+        soql = """SELECT QualifiedApiName,IsIndexed
+                  FROM FieldDefinition
+                  WHERE EntityDefinitionId='{}'""".format(self.name)
+        return list(query.query(soql))
+
     def get_sf_field_definition(self):
         '''
         Run a query against salesforce FieldDefinition table to get extra
         field information.
-        Data is cached for reuse.
+        Data is cached for reuse, in memory and on disk.
 
         Note that this table cannot be fetched entirely. Attempt result in:
         > MALFORMED_QUERY: FieldDefinition: a filter on a reified column is
         > required [EntityDefinitionId,DurableId]
         '''
         if self.__sf_field_definition_cache is None:
-            soql = """SELECT QualifiedApiName,IsIndexed
-                      FROM FieldDefinition
-                      WHERE EntityDefinitionId='{}'""".format(self.name)
-            qry = query.query(soql)
-            self.__sf_field_definition_cache = list(qry)
+            self.__load_metadata()
         return self.__sf_field_definition_cache
 
     def get_sf_fields(self):
@@ -89,7 +89,8 @@ def upload_csv(
         while True:
             try:
                 bulk.wait_for_batch(jobid, batchid)
-            except requests.exceptions.ConnectionError as exc:
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as exc:
                 logger.error('wait_for_batch failed, retrying...: %s', exc)
                 time.sleep(1)
             else: